@@ -0,0 +1,79 @@
+# Compares latency and accuracy of the local model variants on the notebook's test split.
+# Usage: python benchmark_model.py <cyberbullying_tweets.csv> <save_pretrained directory> [--onnx cyberbullying_model.onnx]
+# Requires pandas and scikit-learn, like the notebook.
+import argparse
+import os
+import time
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from local_model import BertScorer, OnnxScorer
+from export_model import quantized_path_for
+
+
+def load_test_split(csv_path: str):
+    """Reproduces the test split of `cyberbullying_classifier.ipynb`."""
+    data = pd.read_csv(csv_path)
+    tweets = data["tweet_text"].values
+    labels = (data["cyberbullying_type"] != "not_cyberbullying").astype(int).values
+    _, test_tweets, _, test_labels = train_test_split(
+        tweets, labels, test_size=0.2, random_state=42
+    )
+    return list(test_tweets), list(test_labels)
+
+
+def benchmark(name: str, scorer, tweets, labels, single_samples: int = 200):
+    """Prints throughput, single message latency, accuracy, precision and recall of `scorer`."""
+    start = time.perf_counter()
+    scores = scorer.predict(tweets)
+    batch_seconds = time.perf_counter() - start
+
+    # Messages in the bot usually arrive one at a time.
+    latencies = []
+    for tweet in tweets[:single_samples]:
+        start = time.perf_counter()
+        scorer.predict([tweet])
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    predictions = [int(score > 0.5) for score in scores]
+    true_positives = sum(p and l for p, l in zip(predictions, labels))
+    accuracy = sum(p == l for p, l in zip(predictions, labels)) / len(labels)
+    precision = true_positives / max(sum(predictions), 1)
+    recall = true_positives / max(sum(labels), 1)
+    print(
+        "{:<12s} {:>8.2f} msg/s {:>8.1f} ms p50 {:>8.1f} ms p95 {:>7.2f}% acc {:>7.2f}% prec {:>7.2f}% rec".format(
+            name,
+            len(tweets) / batch_seconds,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000,
+            accuracy * 100,
+            precision * 100,
+            recall * 100,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_path", help="cyberbullying_tweets.csv")
+    parser.add_argument("model_path", help="directory written by save_pretrained")
+    parser.add_argument("--onnx", default="cyberbullying_model.onnx")
+    parser.add_argument(
+        "--limit", type=int, default=None, help="only use the first N tweets"
+    )
+    args = parser.parse_args()
+
+    tweets, labels = load_test_split(args.csv_path)
+    if args.limit is not None:
+        tweets, labels = tweets[: args.limit], labels[: args.limit]
+
+    # The notebook's settings as the baseline
+    benchmark("fp32-512", BertScorer(args.model_path, max_tokens=512), tweets, labels)
+    benchmark("fp32", BertScorer(args.model_path), tweets, labels)
+    benchmark("int8", BertScorer(args.model_path, quantize=True), tweets, labels)
+    if os.path.isfile(args.onnx):
+        benchmark("onnx", OnnxScorer(args.onnx), tweets, labels)
+    if os.path.isfile(quantized_path_for(args.onnx)):
+        benchmark(
+            "onnx-int8", OnnxScorer(quantized_path_for(args.onnx)), tweets, labels
+        )
@@ -1,26 +1,44 @@
 # bot.py
+import argparse
 import discord
-from datetime import date
+import multiprocessing
 import os
 import json
 import logging
 import re
 from report import Report
 from report import State
+from report import StoredReport
 from review import Review
 from statistics import Statistics
-import heapq
+from guild_state import GuildState
+from journal import QueueJournal
+from message_deleter import MessageDeleter
+from message_index import MessageIndex
+from message_cache import MessageCache
+from report_queue import ReportQueue
+from shard_store import ShardStore
+from thresholds import ThresholdController
+from collections import deque
+import asyncio
 import perspective
+from throttling import ScoringUnavailable
 from typing import Literal
 
-# Set up logging to the console
 logger = logging.getLogger("discord")
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
-handler.setFormatter(
-    logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
-)
-logger.addHandler(handler)
+
+
+def setup_logging():
+    """Logs to `discord.log`.
+    Only called by the main process: scoring workers import this module again and must not truncate the log.
+    """
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
+    )
+    logger.addHandler(handler)
+
 
 # There should be a file called 'tokens.json' inside the same folder as this file
 token_path = "tokens.json"
@@ -32,29 +50,97 @@ with open(token_path) as f:
     discord_token = tokens["discord"]
 
 
-class ModBot(discord.Client):
+class ModBot(discord.AutoShardedClient):
     STRIKE_LIMIT = 3
+    # Initial auto-moderation thresholds. They are adjusted from review outcomes and the auto-report inflow.
     AUTOREPORT_THRESHOLD = 0.7
     AUTOSUSPEND_THRESHOLD = 0.8
     AUTOBAN_THRESHOLD = 0.95
+    # Range each threshold may be adjusted in. The ranges must not overlap.
+    THRESHOLD_BOUNDS = {
+        "AUTOREPORT_THRESHOLD": (0.6, 0.78),
+        "AUTOSUSPEND_THRESHOLD": (0.78, 0.9),
+        "AUTOBAN_THRESHOLD": (0.9, 0.99),
+    }
+    TARGET_AUTOREPORTS_PER_HOUR = (
+        20  # Inflow of auto-reports moderators can keep up with
+    )
+    # Users whose decayed average concern score rises above this are auto-reported,
+    # even if no single message crosses AUTOREPORT_THRESHOLD.
+    BURST_THRESHOLD = 0.5
+    # Precision each automatic action should reach, used to suggest thresholds
+    TARGET_PRECISIONS = {
+        "AUTOREPORT_THRESHOLD": 0.5,
+        "AUTOSUSPEND_THRESHOLD": 0.8,
+        "AUTOBAN_THRESHOLD": 0.95,
+    }
     PERFORMANCE_KEYWORD = "performance"
+    QUEUE_KEYWORD = "queue"
+    CALIBRATION_KEYWORD = "calibration"
+    LEASE_TIMEOUT = (
+        15 * 60
+    )  # Seconds a moderator may hold a report before it is requeued
+    LEASE_CHECK_INTERVAL = 30  # Seconds between checks for expired leases
+    STATISTICS_PATH = (
+        "statistics-{guild_id}.db"  # SQLite database of each guild's statistics
+    )
+    JOURNAL_PATH = (
+        "queue-{guild_id}"  # Journal and snapshot of each guild's review queue
+    )
+    GUILD_IDLE_HORIZON = (
+        24 * 60 * 60
+    )  # Seconds before the state of an idle guild is dropped
+    SHARD_STORE_PATH = "shared.db"  # SQLite database shared by all processes
+    FORWARD_CHECK_INTERVAL = (
+        1  # Seconds between checks for reports forwarded by other processes
+    )
+    DEFERRED_LIMIT = (
+        10000  # Messages kept for scoring while the scoring API is unavailable
+    )
+    DEFERRED_CHECK_INTERVAL = 5  # Seconds between attempts to score deferred messages
+    DELETE_BATCH_WINDOW = (
+        1  # Seconds to collect messages of banned users before deleting them
+    )
+    MAX_INDEXED_MESSAGES = (
+        50000  # Recent messages per guild whose authors are remembered
+    )
+    MESSAGE_CACHE_SIZE = (
+        10000  # Recent messages kept to resolve message links in reports
+    )
+    PREWARM_PERSPECTIVE = True  # Connect to the scoring backend on startup
+    SCORE_BATCH_WINDOW = 0.02  # Seconds to wait for more messages to score together
+    SCORE_BATCH_SIZE = 16  # Maximum number of messages scored together
     # PURGE_KEYWORD = "clear"
 
-    def __init__(self):
+    def __init__(self, shard_ids=None, shard_count=None):
+        """Runs the shards `shard_ids` out of `shard_count`. By default, runs all shards Discord recommends."""
         intents = discord.Intents.default()
         intents.message_content = True
         intents.members = (
             True  # This is to get the list of members in the Group 34 channel
         )
-        super().__init__(command_prefix=".", intents=intents)
+        super().__init__(
+            command_prefix=".",
+            intents=intents,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
+        )
         self.group_num = None
-        self.mod_channel: discord.TextChannel = None  # Mod channel id for that guild
-        self.regular_channel: discord.TextChannel = None  # Regular channel id
+        # Map from guild IDs to the IDs of their (mod channel, regular channel)
+        self.group_channels = {}
+        self.guild_states = {}  # Map from guild IDs to the state of guilds in use
         self.unfinished_reports = {}  # Map from user IDs to the state of their report
-        self.unreviewed_reports = []  # Priority queue storing unreviewed reports
-        self.cur_review = None  # Review in progress
-        self.banned_users = set()
-        self.statistics = Statistics()
+        # Messages that couldn't be scored yet, oldest first
+        self.deferred_messages = deque()
+        self.store = ShardStore(self.SHARD_STORE_PATH)
+        perspective.score_cache.load()
+        self.background_tasks = set()  # Keeps a reference to running background tasks
+        self.periodic_tasks_started = False
+        self.scorer = perspective.ScoreBatcher(
+            self.SCORE_BATCH_WINDOW, self.SCORE_BATCH_SIZE
+        )
+        self.deleter = MessageDeleter(self.DELETE_BATCH_WINDOW)
+        self.message_cache = MessageCache(self.MESSAGE_CACHE_SIZE)
 
     async def on_ready(self):
         print(f"{self.user.name} has connected to Discord! It is these guilds:")
@@ -73,11 +159,122 @@ class ModBot(discord.Client):
 
         # Find the mod channel in each guild that this bot should report to
         for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f"group-{self.group_num}-mod":
-                    self.mod_channel = channel
-                if channel.name == f"group-{self.group_num}":
-                    self.regular_channel = channel
+            self.index_guild(guild)
+
+        if not self.periodic_tasks_started:
+            self.periodic_tasks_started = True
+            self.run_in_background(self.reclaim_expired_leases_periodically())
+            self.run_in_background(self.score_deferred_messages_periodically())
+            if self.shard_ids is not None:
+                # Other processes run the remaining shards
+                self.run_in_background(self.receive_forwarded_reports_periodically())
+
+        # Connect to the scoring backend now, so the first message isn't slowed down
+        if self.PREWARM_PERSPECTIVE:
+            await perspective.warm_up()
+
+    async def close(self):
+        # Messages of banned users still waiting to be deleted
+        self.deleter.flush()
+        await asyncio.gather(*self.deleter.tasks, return_exceptions=True)
+        perspective.score_cache.save()
+        for state in self.guild_states.values():
+            state.close()
+        self.store.close()
+        await perspective.close()
+        await super().close()
+
+    # -------- Guilds --------
+    def index_guild(self, guild: discord.Guild):
+        """Looks up the group channels of `guild`. Guilds without both channels are not moderated."""
+        mod_channel = None
+        regular_channel = None
+        for channel in guild.text_channels:
+            if channel.name == f"group-{self.group_num}-mod":
+                mod_channel = channel
+            if channel.name == f"group-{self.group_num}":
+                regular_channel = channel
+        if mod_channel is None or regular_channel is None:
+            self.group_channels.pop(guild.id, None)
+            return
+        self.group_channels[guild.id] = (mod_channel.id, regular_channel.id)
+        state = self.guild_states.get(guild.id)
+        if state is not None:
+            state.mod_channel = mod_channel
+            state.regular_channel = regular_channel
+
+    def guild_state(self, guild: discord.Guild):
+        """Returns the state of `guild`, creating it on first use. Returns None for guilds without group channels."""
+        state = self.guild_states.get(guild.id)
+        if state is not None:
+            state.touch()
+            return state
+        if guild.id not in self.group_channels:
+            return None
+        mod_channel_id, regular_channel_id = self.group_channels[guild.id]
+        thresholds = ThresholdController(
+            {name: getattr(self, name) for name in self.THRESHOLD_BOUNDS},
+            self.THRESHOLD_BOUNDS,
+            self.TARGET_PRECISIONS,
+            self.TARGET_AUTOREPORTS_PER_HOUR,
+        )
+        statistics = Statistics(
+            self.STATISTICS_PATH.format(guild_id=guild.id), thresholds
+        )
+        statistics.start_flushing()
+        # Recover the reports that weren't reviewed before the last shutdown
+        journal = QueueJournal(self.JOURNAL_PATH.format(guild_id=guild.id))
+        unreviewed_reports = ReportQueue(journal)
+        for journal_id, (score, data) in journal.live.items():
+            unreviewed_reports.insert(score, StoredReport(journal_id, data))
+        journal.start_flushing()
+        state = GuildState(
+            guild.id,
+            guild.get_channel(mod_channel_id),
+            guild.get_channel(regular_channel_id),
+            unreviewed_reports,
+            statistics,
+            thresholds,
+            self.store.banned_users(guild.id),
+            MessageIndex(self.MAX_INDEXED_MESSAGES),
+        )
+        self.guild_states[guild.id] = state
+        return state
+
+    def evict_idle_guilds(self):
+        """Drops the state of guilds that have been idle for GUILD_IDLE_HORIZON. Statistics stay on disk."""
+        # Reports in progress still hold on to their guild's state
+        reporting = {id(r.guild) for r in self.unfinished_reports.values()}
+        for guild_id, state in list(self.guild_states.items()):
+            if state.is_idle(self.GUILD_IDLE_HORIZON) and id(state) not in reporting:
+                state.close()
+                del self.guild_states[guild_id]
+
+    def shard_of(self, guild_id: int) -> int:
+        return (guild_id >> 22) % self.shard_count
+
+    def owns_guild(self, guild_id: int) -> bool:
+        """Whether guild `guild_id` belongs to one of the shards of this process."""
+        return self.shard_ids is None or self.shard_of(guild_id) in self.shard_ids
+
+    async def on_guild_join(self, guild):
+        self.index_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.group_channels.pop(guild.id, None)
+        state = self.guild_states.pop(guild.id, None)
+        if state is not None:
+            state.close()
+
+    async def on_guild_channel_create(self, channel):
+        self.index_guild(channel.guild)
+
+    async def on_guild_channel_delete(self, channel):
+        self.index_guild(channel.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name:
+            self.index_guild(after.guild)
 
     async def on_message(self, message):
         """
@@ -90,14 +287,43 @@ class ModBot(discord.Client):
 
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
-            if message.channel.name == f"group-{self.group_num}":
-                await self.handle_normal_channel_message(message)
-
-            if message.channel.name == f"group-{self.group_num}-mod":
-                await self.handle_mod_channel_message(message)
+            channels = self.group_channels.get(message.guild.id)
+            if channels is None:
+                return
+            mod_channel_id, regular_channel_id = channels
+            if message.channel.id == regular_channel_id:
+                guild = self.guild_state(message.guild)
+                # Banned users can't post. Don't spend anything on scoring their messages.
+                if guild.is_banned(message.author):
+                    self.deleter.delete(message)
+                    return
+                guild.message_index.add(message.id, message.author.id)
+                self.message_cache.add(message)
+                await self.handle_normal_channel_message(guild, message)
+            elif message.channel.id == mod_channel_id:
+                await self.handle_mod_channel_message(
+                    self.guild_state(message.guild), message
+                )
         else:
             await self.handle_dm(message)
 
+    async def on_raw_message_edit(self, payload):
+        # Fetched again on the next lookup, so reports see the current content
+        self.message_cache.discard(
+            (payload.guild_id, payload.channel_id, payload.message_id)
+        )
+
+    async def on_raw_message_delete(self, payload):
+        self.message_cache.discard(
+            (payload.guild_id, payload.channel_id, payload.message_id)
+        )
+
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.message_cache.discard(
+                (payload.guild_id, payload.channel_id, message_id)
+            )
+
     async def handle_dm(self, message):
         # Handle a help message
         if message.content == Report.HELP_KEYWORD:
@@ -146,10 +372,14 @@ class ModBot(discord.Client):
         # Add completed report to review queue
         if self.unfinished_reports[author_id].report_complete():
             cur_report = self.unfinished_reports[author_id]
-            self.push_report(cur_report.score, cur_report)
-            await self.mod_channel.send(
-                f"There are {len(self.unreviewed_reports)} reports outstanding."
-            )
+            guild = cur_report.guild
+            if guild is None:
+                await self.forward_report(cur_report)
+            else:
+                self.push_report(guild, cur_report)
+                await guild.mod_channel.send(
+                    f"There are {len(guild.unreviewed_reports)} reports outstanding."
+                )
         # Remove report from internal map.
         if (
             self.unfinished_reports[author_id].report_canceled()
@@ -157,74 +387,162 @@ class ModBot(discord.Client):
         ):
             self.unfinished_reports.pop(author_id)
 
-    async def handle_normal_channel_message(self, message):
+    async def handle_normal_channel_message(self, guild: GuildState, message):
         """Runs our classifier against the message and updates all statistics accordingly.
         Will ban users for extremely hateful comments.
         """
         # if message.content == self.PURGE_KEYWORD:
-        #     await self.regular_channel.purge(reason="Clearing messages for video.")
+        #     await guild.regular_channel.purge(reason="Clearing messages for video.")
         #     return
 
-        score = perspective.analyze_text(message.content)
+        try:
+            score = await self.scorer.score(message.content)
+        except ScoringUnavailable:
+            self.defer_message(message)
+            return
+        except Exception:
+            # E.g. the API doesn't support the message's language. Retrying won't help.
+            logger.exception(f"Couldn't score message {message.id}")
+            return
+        await self.handle_score(guild, message, score)
+
+    async def handle_score(self, guild: GuildState, message, score: float):
+        """Updates the statistics with the score of `message` and takes automatic action."""
         # Sets up the autoreport
-        self.statistics.add_sentiment(message.author.id, score)
-        if score > self.AUTOBAN_THRESHOLD:
-            await self.mod_channel.send(
+        statistics = guild.statistics
+        await statistics.load_user_async(message.author.id)
+        decayed_before = statistics.get_decayed_sentiment_score(message.author.id)
+        statistics.add_sentiment(message.author.id, score)
+        decayed = statistics.get_decayed_sentiment_score(message.author.id)
+        # Moderators decide about messages only the prefilter has scored
+        trusted = not isinstance(score, perspective.DegradedScore)
+        if trusted and score > guild.thresholds["AUTOBAN_THRESHOLD"]:
+            await guild.mod_channel.send(
                 f"User `{message.author.name}` got auto-banned for a message with concern score {round(score * 100 , 2)}%."
             )
-            await self.ban_user(message.author, message.content, False)
-        elif score > self.AUTOSUSPEND_THRESHOLD:
-            await self.mod_channel.send(
+            await self.ban_user(guild, message.author, message.content, False)
+        elif trusted and score > guild.thresholds["AUTOSUSPEND_THRESHOLD"]:
+            await guild.mod_channel.send(
                 f"User `{message.author.name}` got auto-suspended for a message with concern score {round(score * 100 , 2)}%."
             )
-            await self.enforce_strike(message.author, message.content, False)
-        elif score > self.AUTOREPORT_THRESHOLD:
-            autoreport = Report(self)
-            autoreport.abuse_type = "Bullying or harrasment"
-            autoreport.author = self.user
-            autoreport.message = message
-            autoreport.score = score
-            autoreport.state = State.REPORT_COMPLETE
-            autoreport.date_submitted = date.today()
-            self.push_report(score, autoreport)
-            await self.mod_channel.send(
-                f"There are {len(self.unreviewed_reports)} reports outstanding."
-            )
+            await self.enforce_strike(guild, message.author, message.content, False)
+        elif score > guild.thresholds["AUTOREPORT_THRESHOLD"]:
+            await self.auto_report(guild, message, score)
+        elif decayed > self.BURST_THRESHOLD * 100 >= decayed_before:
+            # The user just started escalating. Report once per burst.
+            await self.auto_report(guild, message, decayed / 100)
+
+    def defer_message(self, message):
+        """Keeps a message that couldn't be scored, so that it is scored once the API recovers."""
+        if len(self.deferred_messages) >= self.DEFERRED_LIMIT:
+            self.deferred_messages.popleft()
+            perspective.call_statistics.dropped += 1
+        self.deferred_messages.append(message)
+        perspective.call_statistics.deferred += 1
+
+    async def score_deferred_messages(self):
+        """Scores the deferred messages in order, until the API is unavailable again."""
+        while self.deferred_messages:
+            message = self.deferred_messages[0]
+            try:
+                score = await self.scorer.score(message.content)
+            except ScoringUnavailable:
+                return
+            except Exception:
+                logger.exception(f"Couldn't score message {message.id}")
+                score = None
+            # New messages might have pushed this one out in the meantime
+            if self.deferred_messages and self.deferred_messages[0] is message:
+                self.deferred_messages.popleft()
+            if score is None:
+                continue
+            guild = self.guild_state(message.guild)
+            if guild is not None:
+                await self.handle_score(guild, message, score)
+
+    async def score_deferred_messages_periodically(self):
+        while True:
+            await asyncio.sleep(self.DEFERRED_CHECK_INTERVAL)
+            await self.score_deferred_messages()
+
+    async def auto_report(self, guild: GuildState, message, score):
+        """Files a report against `message` on behalf of the bot."""
+        autoreport = Report(self)
+        autoreport.guild = guild
+        autoreport.abuse_type = "Bullying or harrasment"
+        autoreport.author = self.user
+        autoreport.message = message
+        autoreport.score = score
+        autoreport.state = State.REPORT_COMPLETE
+        autoreport.mark_submitted()
+        guild.thresholds.record_autoreport()
+        self.push_report(guild, autoreport)
+        await guild.mod_channel.send(
+            f"There are {len(guild.unreviewed_reports)} reports outstanding."
+        )
 
-    async def handle_mod_channel_message(self, message):
+    async def handle_mod_channel_message(self, guild: GuildState, message):
         # Handle a help message
         if message.content == Review.HELP_KEYWORD:
             reply = "Use the `review` command to begin the reviewing process.\n"
             reply += "Use the `cancel` command to cancel the reviewing process.\n"
-            reply += "Use the `performance` command to review the accuracy of the API."
+            reply += (
+                "Use the `performance` command to review the accuracy of the API.\n"
+            )
+            reply += (
+                "Use the `queue` command to see how long reports wait for a review.\n"
+            )
+            reply += "Use the `calibration` command to get suggested thresholds, "
+            reply += (
+                "or `calibration <low%> <high%> [step%]` to inspect any score range."
+            )
             await message.channel.send(reply)
             return
 
         # Handle checking on the API performance
         if message.content == self.PERFORMANCE_KEYWORD:
-            reply = self.statistics.api_statistics_overview()
+            reply = guild.statistics.api_statistics_overview()
+            reply += "\n" + perspective.score_cache.overview()
+            reply += "\n" + perspective.cascade_statistics.overview()
+            reply += "\n" + perspective.call_statistics.overview(
+                perspective.circuit_breaker
+            )
+            reply += "\n" + self.message_cache.overview()
             await message.channel.send(reply)
             return
 
+        # Handle checking on the calibration of the thresholds
+        if message.content.startswith(self.CALIBRATION_KEYWORD):
+            await message.channel.send(
+                self.calibration_overview(guild, message.content)
+            )
+            return
+
+        # Handle checking on the review queue
+        if message.content == self.QUEUE_KEYWORD:
+            await message.channel.send(guild.unreviewed_reports.age_overview())
+            return
+
         # # Purges all messages in the mod channel
         # if message.content == self.PURGE_KEYWORD:
-        #     await self.mod_channel.purge(
+        #     await guild.mod_channel.purge(
         #         limit=None, reason="Clearing messsages for video."
         #     )
         #     return
 
+        moderator_id = message.author.id
         # Only respond to messages if they're part of a review flow
-        if self.cur_review is None and not message.content.startswith(
+        if moderator_id not in guild.reviews and not message.content.startswith(
             Review.START_KEYWORD
         ):
             return
 
-        # If we don't currently have a review, create one
-        if self.cur_review is None:
-            self.cur_review = Review(self)
+        # If this moderator doesn't currently have a review, create one
+        if moderator_id not in guild.reviews:
+            guild.reviews[moderator_id] = Review(self, guild, moderator_id)
 
         # Let the review class handle this message; forward all the messages it returns to us
-        responses = await self.cur_review.handle_message(message)
+        responses = await guild.reviews[moderator_id].handle_message(message)
         for r in responses:
             if type(r) is tuple:
                 # Some responses might include a View.
@@ -233,76 +551,193 @@ class ModBot(discord.Client):
                 await message.channel.send(r)
         # If the review is complete or cancelled, clean up resources
         # We do this here just in case the report is not completed by a View callback.
-        # View callback's must call `clean_up_report` themselves.
-        await self.clean_up_review()
-
-    def pop_highest_priority_report(self):
-        """Pops unreviewed report with the highest priority."""
-        score_report = heapq.heappop(self.unreviewed_reports)
-        return (-score_report[0], score_report[1])
-
-    def pop_oldest_report(self):
-        """Pops oldest unreviewed report."""
-        oldest_i = 0
-        (oldest_score, oldest_report) = self.unreviewed_reports[0]
-        for i, (score, report) in enumerate(self.unreviewed_reports):
-            if report.date_submitted < oldest_report.date_submitted:
-                oldest_i = i
-                oldest_score = score
-                oldest_report = report
-        del self.unreviewed_reports[oldest_i]
-        heapq.heapify(self.unreviewed_reports)
-        return (-oldest_score, oldest_report)
-
-    def push_report(self, score, report):
-        heapq.heappush(self.unreviewed_reports, (-score, report))
+        # View callback's must call `clean_up_review` themselves.
+        await self.clean_up_review(guild, moderator_id)
+
+    def calibration_overview(self, guild: GuildState, command: str) -> str:
+        """Answers `calibration` and `calibration <low%> <high%> [step%]`."""
+        args = command.split()[1:]
+        if not args:
+            return guild.statistics.calibration.threshold_overview(
+                [
+                    (name, guild.thresholds[name], target)
+                    for name, target in self.TARGET_PRECISIONS.items()
+                ]
+            )
+        try:
+            bounds = [float(arg) / 100 for arg in args]
+        except ValueError:
+            bounds = []
+        if len(bounds) not in (2, 3) or not 0 <= bounds[0] < bounds[1] <= 1:
+            return "Usage: `calibration <low%> <high%> [step%]`, e.g. `calibration 60 80 2`."
+        step = bounds[2] if len(bounds) == 3 else 0.01
+        # Keep the reply short enough for a single Discord message
+        step = max(step, (bounds[1] - bounds[0]) / 50)
+        return guild.statistics.api_statistics_overview(bounds[0], bounds[1], step)
+
+    async def lease_report(self, guild: GuildState, moderator_id, oldest: bool):
+        """Leases the oldest or the most urgent unreviewed report of `guild` to a moderator.
+        Returns None if there are no reports left.
+        """
+        while True:
+            if oldest:
+                lease = guild.unreviewed_reports.lease_oldest(
+                    moderator_id, self.LEASE_TIMEOUT
+                )
+            else:
+                lease = guild.unreviewed_reports.lease_highest_priority(
+                    moderator_id, self.LEASE_TIMEOUT
+                )
+            if lease is None or not isinstance(lease.report, StoredReport):
+                return lease
+            # Reports recovered from the journal are fetched from Discord once they're needed
+            report = await lease.report.resolve(self, guild)
+            if report is not None:
+                guild.unreviewed_reports.replace_leased(lease, report)
+                return lease
+            # The reported message was deleted in the meantime
+            guild.unreviewed_reports.complete(lease)
+
+    async def reclaim_expired_leases(self, guild: GuildState):
+        """Puts reports back into the queue if their moderator abandoned the review."""
+        for lease in guild.unreviewed_reports.reclaim_expired():
+            review = guild.reviews.get(lease.holder)
+            if review is not None and review.lease is lease:
+                del guild.reviews[lease.holder]
+            if lease.removed:
+                # The reported user was banned in the meantime
+                continue
+            await guild.mod_channel.send(
+                f"<@{lease.holder}> took too long to review a report. It was put back into the queue."
+            )
+
+    async def reclaim_expired_leases_periodically(self):
+        while True:
+            await asyncio.sleep(self.LEASE_CHECK_INTERVAL)
+            for guild in list(self.guild_states.values()):
+                await self.reclaim_expired_leases(guild)
+                guild.thresholds.tick()
+            self.evict_idle_guilds()
+
+    def push_report(self, guild: GuildState, report):
+        """Queues `report`, unless the same message is queued already. Then the reports are merged."""
+        if not guild.unreviewed_reports.merge(report):
+            guild.unreviewed_reports.push(report.priority(), report)
+
+    async def forward_report(self, report):
+        """Hands a report against a message in a guild of another process over to that process."""
+        guild_id = report.message.guild.id
+        await asyncio.to_thread(
+            self.store.forward_report,
+            self.shard_of(guild_id),
+            guild_id,
+            report.to_dict(),
+        )
+
+    async def receive_forwarded_reports(self):
+        """Queues the reports other processes forwarded to the shards of this process."""
+        forwarded = await asyncio.to_thread(self.store.take_reports, self.shard_ids)
+        for guild_id, data in forwarded:
+            discord_guild = self.get_guild(guild_id)
+            guild = None if discord_guild is None else self.guild_state(discord_guild)
+            if guild is None:
+                logger.warning(
+                    f"Dropped a report forwarded to unmoderated guild {guild_id}"
+                )
+                continue
+            try:
+                report = await Report.restore(self, guild, data)
+            except discord.errors.HTTPException:
+                logger.exception(
+                    f"Couldn't restore a report forwarded to guild {guild_id}"
+                )
+                continue
+            if report is None:
+                continue
+            await report.load_statistics()
+            guild.statistics.increment_reports_against(report.message.author.id)
+            guild.statistics.increment_reports_sent(report.author.id)
+            self.push_report(guild, report)
+            if report.partial_score:
+                # The sending process forwarded the report before all scores were in
+                messages = [report.message] + report.additional_msgs
+                self.run_in_background(
+                    report.rescore(messages, report.score_messages(messages))
+                )
+            await guild.mod_channel.send(
+                f"There are {len(guild.unreviewed_reports)} reports outstanding."
+            )
+
+    async def receive_forwarded_reports_periodically(self):
+        while True:
+            await asyncio.sleep(self.FORWARD_CHECK_INTERVAL)
+            await self.receive_forwarded_reports()
+
+    def run_in_background(self, coro):
+        """Runs `coro` as a task without awaiting it."""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
 
     async def enforce_strike(
-        self, user, message_content: str, adversarial: bool
+        self, guild: GuildState, user, message_content: str, adversarial: bool
     ) -> bool:
         """
-        Adds a strike to the user's account.
+        Adds a strike to the user's account in `guild`.
         If the user has STRIKE_LIMIT strikes, the user will be banned. Otherwise, the user will be suspended.
         """
-        if self.statistics.add_and_check_strike(user.id, self.STRIKE_LIMIT):
-            await self.mod_channel.send(
+        # explain_review reads the strikes again when suspending
+        await guild.statistics.load_user_async(user.id)
+        if guild.statistics.add_and_check_strike(user.id, self.STRIKE_LIMIT):
+            await guild.mod_channel.send(
                 f"This is the user's 3rd strike. They will be banned..."
             )
             await self.ban_user(
+                guild,
                 user,
                 message_content,
                 adversarial,
             )
         else:
             await self.suspend_user(
+                guild,
                 user,
                 message_content,
                 adversarial,
             )
 
-    async def delete_messages(self, user):
-        """Deletes all messages from user `user_id`."""
-        deleted = await self.regular_channel.purge(
-            check=lambda m: m.author == user, reason="Account Banned"
+    async def delete_messages(self, guild: GuildState, user):
+        """Deletes all messages from user `user_id`.
+
+        Recent messages are looked up in the message index and deleted in bulk. The channel
+        history is only scanned for messages older than the index, if the user could have sent any.
+        """
+        channel = guild.regular_channel
+        index = guild.message_index
+        deleted = await self.deleter.delete_now(
+            channel,
+            [channel.get_partial_message(i) for i in index.pop_author(user.id)],
         )
-        await self.mod_channel.send(
-            f"{len(deleted)} messages from user {user.name} have been deleted."
+        # Members who joined after the horizon (e.g. raid accounts) have no older messages
+        joined_at = getattr(user, "joined_at", None)
+        if joined_at is None or joined_at < index.horizon_time():
+            older = await channel.purge(
+                before=discord.Object(index.horizon + 1),
+                check=lambda m: m.author.id == user.id,
+                reason="Account Banned",
+            )
+            deleted += len(older)
+        await guild.mod_channel.send(
+            f"{deleted} messages from user {user.name} have been deleted."
         )
 
-    async def delete_associated_reports(self, user):
+    async def delete_associated_reports(self, guild: GuildState, user):
         """Deletes all unreviewed reports that the user is involved in."""
-        self.unreviewed_reports = [
-            (score, report)
-            for (score, report) in self.unreviewed_reports
-            if report.message.author != user
-        ]
-        heapq.heapify(self.unreviewed_reports)
-
-    def is_banned(self, user):
-        return user in self.banned_users
+        guild.unreviewed_reports.remove_user(user.id)
 
     def explain_review(
         self,
+        guild: GuildState,
         message_content: str,
         adversarial: bool,
         action: Literal["suspend", "ban"],
@@ -313,7 +748,7 @@ class ModBot(discord.Client):
         if action == "suspend":
             ban_msg = (
                 "After "
-                + str(self.STRIKE_LIMIT - self.statistics.get_strikes(user.id))
+                + str(self.STRIKE_LIMIT - guild.statistics.get_strikes(user.id))
                 + " suspension(s) any further violations will get your account banned.\n"
                 + ban_msg
             )
@@ -330,27 +765,34 @@ class ModBot(discord.Client):
             + ban_msg
         )
 
-    async def ban_user(self, user, message_content: str, adversarial: bool):
+    async def ban_user(
+        self, guild: GuildState, user, message_content: str, adversarial: bool
+    ):
         # Explain violations and ban user
         embed = discord.Embed(
             title="Your account has been banned!",
-            description=self.explain_review(message_content, adversarial, "ban", user),
+            description=self.explain_review(
+                guild, message_content, adversarial, "ban", user
+            ),
             color=discord.Color.red(),
             url="https://discord.com/guidelines",
         )
         embed.set_author(name="Community Moderators")
         await user.send(embed=embed)
-        self.banned_users.add(user)
+        guild.banned_users.add(user.id)
+        await asyncio.to_thread(self.store.add_ban, guild.guild_id, user.id)
         # Remove associated reports and messages
-        await self.delete_associated_reports(user)
-        await self.delete_messages(user)
+        await self.delete_associated_reports(guild, user)
+        await self.delete_messages(guild, user)
 
-    async def suspend_user(self, user, message_content: str, adversarial: bool):
+    async def suspend_user(
+        self, guild: GuildState, user, message_content: str, adversarial: bool
+    ):
         # Warn the user with explanation and suspend for 7 days
         embed = discord.Embed(
             title="Your account has been suspended for 7 days!",
             description=self.explain_review(
-                message_content, adversarial, "suspend", user
+                guild, message_content, adversarial, "suspend", user
             ),
             color=discord.Color.orange(),
             url="https://discord.com/guidelines",
@@ -358,24 +800,26 @@ class ModBot(discord.Client):
         embed.set_author(name="Community Moderators")
         await user.send(embed=embed)
 
-    async def clean_up_review(self):
-        if self.cur_review is None:
+    async def clean_up_review(self, guild: GuildState, moderator_id):
+        review = guild.reviews.get(moderator_id)
+        if review is None:
             return
 
-        if self.cur_review.review_canceled() and self.cur_review.report_popped():
-            # We need to put back the popped report
-            self.push_report(self.cur_review.score, self.cur_review.report)
-            self.cur_review = None
+        if review.review_canceled():
+            if review.report_popped():
+                # We need to put back the leased report
+                guild.unreviewed_reports.release(review.lease)
+            del guild.reviews[moderator_id]
             return
 
-        if self.cur_review.review_complete():
+        if review.review_complete():
             embed = discord.Embed(
                 title="Review completed!",
-                description=f"Thank you for reviewing this report. Necessary actions have been taken.\nThere are now {len(self.unreviewed_reports)} reports outstanding.",
+                description=f"Thank you for reviewing this report. Necessary actions have been taken.\nThere are now {len(guild.unreviewed_reports)} reports outstanding.",
                 color=discord.Color.green(),
             )
-            await self.mod_channel.send(embed=embed)
-            self.cur_review = None
+            await guild.mod_channel.send(embed=embed)
+            del guild.reviews[moderator_id]
 
     async def notify_reporter(self, user):
         # Notifies the reporter if the user they reported was punished
@@ -389,5 +833,48 @@ class ModBot(discord.Client):
             await user.send(embed=embed)
 
 
-client = ModBot()
-client.run(discord_token)
+def run(shard_ids=None, shard_count=None, processes=1):
+    # All processes share the API quota
+    perspective.share_quota(processes)
+    client = ModBot(shard_ids, shard_count)
+    client.run(discord_token)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="total number of shards, defaults to the number Discord recommends",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of processes the shards are spread across",
+    )
+    args = parser.parse_args()
+    setup_logging()
+    if args.processes == 1:
+        run(shard_count=args.shards)
+    else:
+        if args.shards is None or args.shards < args.processes:
+            parser.error(
+                "--processes requires --shards to be at least the number of processes"
+            )
+        # Each process runs every `processes`th shard. Shard 0, which receives all DMs, runs in the first.
+        processes = [
+            multiprocessing.Process(
+                target=run,
+                args=(
+                    list(range(i, args.shards, args.processes)),
+                    args.shards,
+                    args.processes,
+                ),
+            )
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
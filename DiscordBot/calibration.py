@@ -0,0 +1,104 @@
+from typing import List, Optional
+
+
+class Calibration:
+    """Streaming histogram of concern scores, split by the outcome of the review.
+
+    Uses a fixed amount of memory no matter how many reports were reviewed.
+    Precision and recall at any threshold are computed in O(BINS).
+    """
+
+    BINS = 100  # Number of equally wide score bins, i.e. 1% per bin
+
+    def __init__(self):
+        self.successful = [0] * self.BINS  # Reports that led to action, per bin
+        self.unsuccessful = [0] * self.BINS  # Reports that were dismissed, per bin
+
+    def bin(self, score: float) -> int:
+        return min(max(int(score * self.BINS), 0), self.BINS - 1)
+
+    def boundary(self, score: float) -> int:
+        """Index of the first bin at or above `score`, for range queries."""
+        return min(max(round(score * self.BINS), 0), self.BINS)
+
+    def add(self, score: float, successful: bool):
+        if successful:
+            self.successful[self.bin(score)] += 1
+        else:
+            self.unsuccessful[self.bin(score)] += 1
+
+    def counts(self, low: float, high: float):
+        """Returns (successful, total) reports with low <= score < high."""
+        bins = range(self.boundary(low), self.boundary(high))
+        successful = sum(self.successful[b] for b in bins)
+        return successful, successful + sum(self.unsuccessful[b] for b in bins)
+
+    def precision_recall(self, threshold: float):
+        """Returns the precision and recall of acting on every report with score >= threshold."""
+        above_successful, above_total = self.counts(threshold, 1)
+        total_successful = sum(self.successful)
+        precision = above_successful / above_total if above_total else 0
+        recall = above_successful / total_successful if total_successful else 0
+        return precision, recall
+
+    def suggest_threshold(
+        self, target_precision: float, min_reports: int = 10
+    ) -> Optional[float]:
+        """Returns the lowest threshold whose precision reaches `target_precision`.
+
+        Returns None if no threshold backed by at least `min_reports` reports does.
+        """
+        suggestion = None
+        above_successful = 0
+        above_total = 0
+        # Walk down from the top, keeping running sums of everything above the threshold.
+        for b in reversed(range(self.BINS)):
+            above_successful += self.successful[b]
+            above_total += self.successful[b] + self.unsuccessful[b]
+            if (
+                above_total >= min_reports
+                and above_successful / above_total >= target_precision
+            ):
+                suggestion = b / self.BINS
+        return suggestion
+
+    def overview(self, low: float = 0, high: float = 1, step: float = 0.05) -> str:
+        """Text chart of how often scores in each range led to successful reports."""
+        lines = [
+            "How often do concern scores in the following ranges lead to successful reports?",
+            "```",
+        ]
+        lower = low
+        while lower < high - 1e-9:
+            upper = min(lower + step, high)
+            successful, total = self.counts(lower, upper)
+            success_rate = successful / total * 100 if total else 0
+            lines.append(
+                "{:>3d}-{:>3d}%:{:>8s}   {}".format(
+                    round(lower * 100),
+                    round(upper * 100),
+                    f"{successful}/{total}",
+                    "∎" * (int(success_rate) // 10),
+                )
+            )
+            lower = upper
+        lines.append("```")
+        return "\n".join(lines)
+
+    def threshold_overview(self, targets: List[tuple]) -> str:
+        """Lists suggested thresholds for (name, current threshold, target precision) triples."""
+        lines = ["Suggested thresholds:", "```"]
+        for name, current, target in targets:
+            precision, recall = self.precision_recall(current)
+            suggestion = self.suggest_threshold(target)
+            lines.append(
+                f"{name}: currently {current} (precision {round(precision * 100, 2)}%, "
+                + f"recall {round(recall * 100, 2)}%), "
+                + (
+                    f"suggested {suggestion} for {round(target * 100)}% precision"
+                    if suggestion is not None
+                    else f"not enough reports for {round(target * 100)}% precision"
+                )
+            )
+        lines.append("```")
+        return "\n".join(lines)
@@ -0,0 +1,49 @@
+# Exports the model trained in `cyberbullying_classifier.ipynb` for fast CPU inference.
+# Usage: python export_model.py <save_pretrained directory> [--output cyberbullying_model.onnx]
+# Writes an fp32 ONNX model and a dynamically int8 quantized copy next to it.
+import argparse
+import torch
+from transformers import BertForSequenceClassification
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+
+def export_onnx(model_path: str, onnx_path: str):
+    """Exports the PyTorch model to ONNX with dynamic batch and sequence sizes."""
+    model = BertForSequenceClassification.from_pretrained(model_path)
+    model.eval()
+    # The values don't matter, only the shapes and types are traced.
+    input_ids = torch.ones((1, 16), dtype=torch.int64)
+    attention_mask = torch.ones((1, 16), dtype=torch.int64)
+    torch.onnx.export(
+        model,
+        (input_ids, attention_mask),
+        onnx_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        },
+        opset_version=14,
+    )
+
+
+def quantize_onnx(onnx_path: str, quantized_path: str):
+    """Stores the weights of the ONNX model as int8."""
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+
+
+def quantized_path_for(onnx_path: str) -> str:
+    return onnx_path[: -len(".onnx")] + ".int8.onnx"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", help="directory written by save_pretrained")
+    parser.add_argument("--output", default="cyberbullying_model.onnx")
+    args = parser.parse_args()
+
+    export_onnx(args.model_path, args.output)
+    quantize_onnx(args.output, quantized_path_for(args.output))
+    print(f"Wrote {args.output} and {quantized_path_for(args.output)}")
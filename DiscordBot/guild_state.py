@@ -0,0 +1,58 @@
+import discord
+from message_index import MessageIndex
+from report_queue import ReportQueue
+from statistics import Statistics
+from thresholds import ThresholdController
+import time
+
+
+class GuildState:
+    """Everything the bot keeps for one guild it moderates.
+
+    Created when the guild first needs it, so memory grows with the number of active guilds.
+    """
+
+    def __init__(
+        self,
+        guild_id: int,
+        mod_channel: discord.TextChannel,
+        regular_channel: discord.TextChannel,
+        unreviewed_reports: ReportQueue,
+        statistics: Statistics,
+        thresholds: ThresholdController,
+        banned_users: set,
+        message_index: MessageIndex,
+    ):
+        self.guild_id = guild_id
+        self.mod_channel = mod_channel
+        self.regular_channel = regular_channel
+        self.unreviewed_reports = unreviewed_reports  # Queue storing unreviewed reports
+        self.reviews = {}  # Map from moderator IDs to their review in progress
+        self.banned_users = (
+            banned_users  # IDs of banned users, also kept in the shard store
+        )
+        self.message_index = (
+            message_index  # Recent messages in the regular channel by author
+        )
+        self.statistics = statistics
+        self.thresholds = thresholds
+        self.last_active = time.monotonic()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def is_banned(self, user) -> bool:
+        return user.id in self.banned_users
+
+    def is_idle(self, horizon: float) -> bool:
+        """Whether nothing happened for `horizon` seconds and nothing would be lost by dropping the state."""
+        return (
+            time.monotonic() - self.last_active > horizon
+            and not self.unreviewed_reports
+            and not self.unreviewed_reports.leases
+            and not self.reviews
+        )
+
+    def close(self):
+        self.statistics.close()
+        self.unreviewed_reports.journal.close()
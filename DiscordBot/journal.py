@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import threading
+
+
+class QueueJournal:
+    """Append-only log of the changes to a report queue, so that the queue survives crashes.
+
+    Records are buffered and written with a single fsync every FLUSH_INTERVAL seconds.
+    Once most records are obsolete, the live reports are written to a snapshot and the
+    journal starts over. Recovery loads the snapshot and replays the journal on top of it.
+    Replaying is idempotent, so a crash in the middle of a compaction loses nothing.
+    """
+
+    FLUSH_INTERVAL = 0.1  # Seconds between writes, i.e. the changes a crash may lose
+    COMPACT_MIN_RECORDS = 1000  # Journal records before a compaction is considered
+
+    def __init__(self, path: str):
+        self.journal_path = path + ".journal"
+        self.snapshot_path = path + ".snapshot"
+        self.live = {}  # Journal id -> (score, report dict) of reports not reviewed yet
+        self.next_id = 0
+        self.records = 0  # Number of records in the journal file
+        self.buffer = []  # Records not written yet
+        self.flush_task: asyncio.Task = None
+        self.file_lock = threading.Lock()  # Writes run in a worker thread
+        self.recover()
+        self.file = open(self.journal_path, "a", encoding="utf-8")
+
+    # -------- Recovery --------
+    def recover(self):
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                for journal_id, score, report in json.load(f):
+                    self.live[journal_id] = (score, report)
+                    self.next_id = max(self.next_id, journal_id + 1)
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last record was only partially written before the crash
+                    break
+                self.apply(record)
+                self.records += 1
+
+    def apply(self, record: dict):
+        journal_id = record["id"]
+        if record["op"] == "push":
+            self.live[journal_id] = (record["score"], record["report"])
+            self.next_id = max(self.next_id, journal_id + 1)
+        elif record["op"] == "remove":
+            self.live.pop(journal_id, None)
+        elif record["op"] == "update" and journal_id in self.live:
+            self.live[journal_id] = (record["score"], record["report"])
+        elif record["op"] == "score" and journal_id in self.live:
+            # Written before reports could be merged, when the priority was the report's score
+            report = self.live[journal_id][1]
+            self.live[journal_id] = (
+                record["score"],
+                {**report, "score": record["score"]},
+            )
+
+    # -------- Changes --------
+    def append(self, record: dict):
+        self.apply(record)
+        self.buffer.append(json.dumps(record))
+
+    def push(self, score: float, report: dict) -> int:
+        """Records a new report. Returns its journal id."""
+        journal_id = self.next_id
+        self.append({"op": "push", "id": journal_id, "score": score, "report": report})
+        return journal_id
+
+    def remove(self, journal_id: int):
+        self.append({"op": "remove", "id": journal_id})
+
+    def update(self, journal_id: int, score: float, report: dict):
+        """Records a new priority and new contents of a report."""
+        self.append(
+            {"op": "update", "id": journal_id, "score": score, "report": report}
+        )
+
+    # -------- Writing --------
+    def write(self, lines):
+        with self.file_lock:
+            self.file.write("".join(line + "\n" for line in lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.records += len(lines)
+
+    def compact(self, live: dict):
+        """Writes `live` to the snapshot and empties the journal."""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([[i, score, report] for i, (score, report) in live.items()], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        with self.file_lock:
+            self.file.seek(0)
+            self.file.truncate()
+            os.fsync(self.file.fileno())
+        self.records = 0
+
+    def needs_compaction(self) -> bool:
+        return self.records > max(self.COMPACT_MIN_RECORDS, 2 * len(self.live))
+
+    def flush(self):
+        """Writes all buffered records. This call blocks."""
+        lines, self.buffer = self.buffer, []
+        if lines:
+            self.write(lines)
+
+    async def flush_async(self):
+        lines, self.buffer = self.buffer, []
+        if lines:
+            await asyncio.to_thread(self.write, lines)
+        if self.needs_compaction():
+            # Records buffered in the meantime are also in the copy. Replaying them again is harmless.
+            await asyncio.to_thread(self.compact, dict(self.live))
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            await self.flush_async()
+
+    def start_flushing(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.flush()
+        self.file.close()
@@ -0,0 +1,110 @@
+# Runs the cyberbullying classifier trained in `cyberbullying_classifier.ipynb` on the CPU.
+# Requires `torch` and `transformers`. The ONNX scorer additionally requires `onnxruntime`.
+from unidecode import unidecode
+from typing import List
+
+MAX_TOKENS = 128  # Discord messages are short, longer inputs are truncated
+BATCH_SIZE = 16  # Maximum number of texts per forward pass
+BUCKET_WIDTH = 8  # Batches are padded to a multiple of this many tokens
+TOKENIZER = "bert-base-uncased"  # The notebook only saves the model, not the tokenizer
+
+
+def bucket_by_length(lengths: List[int], batch_size: int) -> List[List[int]]:
+    """Groups indices of inputs with similar lengths, so that batches need little padding."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+class BucketedScorer:
+    """Tokenizes, buckets and pads texts. Subclasses run the actual model."""
+
+    def __init__(self, max_tokens: int = MAX_TOKENS, batch_size: int = BATCH_SIZE):
+        from transformers import BertTokenizerFast
+
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.tokenizer = BertTokenizerFast.from_pretrained(
+            TOKENIZER, do_lower_case=True
+        )
+
+    def predict(self, texts: List[str]) -> List[float]:
+        """Returns the probability that each text is cyberbullying."""
+        # Convert Unicode characters to ascii characters.
+        # This aims to prevent adversarial unicode texts.
+        encodings = self.tokenizer(
+            [unidecode(text) for text in texts],
+            add_special_tokens=True,
+            max_length=self.max_tokens,
+            truncation=True,
+        )["input_ids"]
+        scores = [0.0] * len(texts)
+        for bucket in bucket_by_length([len(e) for e in encodings], self.batch_size):
+            longest = max(len(encodings[i]) for i in bucket)
+            width = -(-longest // BUCKET_WIDTH) * BUCKET_WIDTH
+            input_ids = []
+            attention_mask = []
+            for i in bucket:
+                padding = width - len(encodings[i])
+                input_ids.append(encodings[i] + [self.tokenizer.pad_token_id] * padding)
+                attention_mask.append([1] * len(encodings[i]) + [0] * padding)
+            for i, score in zip(bucket, self.forward(input_ids, attention_mask)):
+                scores[i] = score
+        return scores
+
+    def forward(
+        self, input_ids: List[List[int]], attention_mask: List[List[int]]
+    ) -> List[float]:
+        """Runs the model on one padded batch and returns the probabilities of label 1."""
+        raise NotImplementedError
+
+
+class BertScorer(BucketedScorer):
+    """Runs the model saved with `save_pretrained` in PyTorch, optionally int8 quantized."""
+
+    def __init__(self, model_path: str, quantize: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+        from transformers import BertForSequenceClassification
+
+        self.torch = torch
+        self.model = BertForSequenceClassification.from_pretrained(model_path)
+        self.model.eval()
+        if quantize:
+            # Dynamic quantization stores the weights of all linear layers as int8.
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+    def forward(self, input_ids, attention_mask):
+        with self.torch.no_grad():
+            logits = self.model(
+                input_ids=self.torch.tensor(input_ids),
+                attention_mask=self.torch.tensor(attention_mask),
+            ).logits
+            return self.torch.softmax(logits, dim=1)[:, 1].tolist()
+
+
+class OnnxScorer(BucketedScorer):
+    """Runs a model exported by `export_model.py` with ONNX Runtime."""
+
+    def __init__(self, onnx_path: str, **kwargs):
+        super().__init__(**kwargs)
+        import numpy as np
+        import onnxruntime
+
+        self.np = np
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, providers=["CPUExecutionProvider"]
+        )
+
+    def forward(self, input_ids, attention_mask):
+        (logits,) = self.session.run(
+            ["logits"],
+            {
+                "input_ids": self.np.array(input_ids, dtype=self.np.int64),
+                "attention_mask": self.np.array(attention_mask, dtype=self.np.int64),
+            },
+        )
+        # Softmax over the two labels
+        exp = self.np.exp(logits - logits.max(axis=1, keepdims=True))
+        return (exp[:, 1] / exp.sum(axis=1)).tolist()
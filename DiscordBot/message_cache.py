@@ -0,0 +1,58 @@
+from cachetools import LRUCache
+import asyncio
+
+
+class MessageCache:
+    """LRU cache of recently seen messages, keyed by (guild id, channel id, message id).
+
+    Resolves message links without a REST call if the bot has seen the message.
+    Concurrent fetches of the same message share a single request.
+    """
+
+    def __init__(self, maxsize: int):
+        self.cache = LRUCache(maxsize)
+        self.in_flight = {}  # Key -> task fetching the message
+        self.hits = 0
+        self.fetches = 0  # REST calls made
+        self.coalesced = 0  # Lookups that waited for another lookup's REST call
+
+    @staticmethod
+    def key(message):
+        return (message.guild.id, message.channel.id, message.id)
+
+    def add(self, message):
+        self.cache[self.key(message)] = message
+
+    def discard(self, key):
+        self.cache.pop(key, None)
+
+    async def fetch(self, key, fetch):
+        """Returns the message `key`. Awaits `fetch()` only if nobody else is fetching it already."""
+        message = self.cache.get(key)
+        if message is not None:
+            self.hits += 1
+            return message
+        task = self.in_flight.get(key)
+        if task is None:
+            self.fetches += 1
+            task = asyncio.ensure_future(fetch())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A cancelled waiter must not cancel the fetch for everyone else
+        message = await asyncio.shield(task)
+        self.cache[key] = message
+        return message
+
+    def overview(self) -> str:
+        lookups = self.hits + self.fetches + self.coalesced
+        hit_rate = 0 if lookups == 0 else round(self.hits / lookups * 100, 2)
+        return (
+            "Message link cache:\n```"
+            + f"\nEntries:   {self.cache.currsize}/{self.cache.maxsize}"
+            + f"\nHits:      {self.hits} ({hit_rate}%)"
+            + f"\nFetches:   {self.fetches}"
+            + f"\nCoalesced: {self.coalesced}"
+            + "\n```"
+        )
@@ -0,0 +1,73 @@
+from collections import defaultdict
+import asyncio
+import discord
+import logging
+
+logger = logging.getLogger("discord.deleter")
+
+
+class MessageDeleter:
+    """Deletes messages in bulk.
+
+    Messages are collected for `window` seconds per channel, then deleted with one
+    bulk delete call per BULK_LIMIT messages, so a spammer costs one API call per batch.
+    """
+
+    BULK_LIMIT = 100  # Most messages Discord deletes in one call
+
+    def __init__(self, window: float):
+        self.window = window
+        self.pending = defaultdict(list)  # Channel -> messages waiting to be deleted
+        self.flush_handle: asyncio.TimerHandle = None
+        self.tasks = set()  # Keeps a reference to the deletions in flight
+        self.deleted = 0
+
+    def delete(self, message: discord.Message):
+        """Queues `message` for deletion."""
+        pending = self.pending[message.channel]
+        pending.append(message)
+        if len(pending) >= self.BULK_LIMIT:
+            self.run(
+                self.delete_now(message.channel, self.pending.pop(message.channel))
+            )
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.window, self.flush
+            )
+
+    def flush(self):
+        """Deletes all queued messages."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, self.pending = self.pending, defaultdict(list)
+        for channel, messages in pending.items():
+            self.run(self.delete_now(channel, messages))
+
+    def run(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def delete_now(self, channel, messages) -> int:
+        """Deletes `messages` from `channel` in chunks of BULK_LIMIT. Returns how many were deleted."""
+        deleted = 0
+        for i in range(0, len(messages), self.BULK_LIMIT):
+            chunk = messages[i : i + self.BULK_LIMIT]
+            try:
+                await channel.delete_messages(chunk, reason="Account Banned")
+            except discord.errors.NotFound:
+                # Some messages are already gone. Delete the rest one by one.
+                for message in chunk:
+                    try:
+                        await message.delete()
+                    except discord.errors.NotFound:
+                        continue
+                    deleted += 1
+                continue
+            except discord.errors.HTTPException:
+                logger.exception(f"Couldn't delete {len(chunk)} messages in #{channel}")
+                continue
+            deleted += len(chunk)
+        self.deleted += deleted
+        return deleted
@@ -0,0 +1,56 @@
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+import discord
+
+
+class MessageIndex:
+    """Remembers the IDs of the recent messages in a channel, by author.
+
+    Holds every message after `horizon` (a message ID), at most `max_messages` of them
+    and none older than MAX_AGE. Whatever falls out moves the horizon forward.
+    Older messages can only be found by scanning the channel history.
+    """
+
+    # Discord only bulk deletes messages younger than 14 days
+    MAX_AGE = timedelta(days=13)
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.messages = deque()  # (message id, author id), oldest first
+        self.by_author = defaultdict(deque)  # Author id -> message ids, oldest first
+        # Nothing was indexed before the index was created
+        self.horizon = discord.utils.time_snowflake(discord.utils.utcnow())
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message_id: int, author_id: int):
+        self.messages.append((message_id, author_id))
+        self.by_author[author_id].append(message_id)
+        self.expire()
+
+    def expire(self):
+        """Drops the oldest messages until the index is within its bounds."""
+        oldest_allowed = discord.utils.time_snowflake(
+            discord.utils.utcnow() - self.MAX_AGE
+        )
+        while self.messages and (
+            len(self.messages) > self.max_messages
+            or self.messages[0][0] < oldest_allowed
+        ):
+            message_id, author_id = self.messages.popleft()
+            self.horizon = max(self.horizon, message_id)
+            author_messages = self.by_author.get(author_id)
+            # The author's messages might have been popped already
+            if author_messages and author_messages[0] == message_id:
+                author_messages.popleft()
+                if not author_messages:
+                    del self.by_author[author_id]
+
+    def pop_author(self, author_id: int) -> list:
+        """Removes and returns the IDs of all indexed messages by `author_id`."""
+        return list(self.by_author.pop(author_id, ()))
+
+    def horizon_time(self) -> datetime:
+        """Messages sent before this time might be missing from the index."""
+        return discord.utils.snowflake_time(self.horizon)
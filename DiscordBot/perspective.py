@@ -1,7 +1,27 @@
 from googleapiclient import discovery
 from unidecode import unidecode
+from score_cache import ScoreCache
+from prefilter import Prefilter, CascadeStatistics, is_trivial
+from throttling import (
+    CallStatistics,
+    CircuitBreaker,
+    ScoringUnavailable,
+    TokenBucket,
+    backoff,
+)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import aiohttp
+import asyncio
 import json
+import logging
+import multiprocessing
 import os
+import scoring_pool
+import threading
+from typing import List, Union
+
+logger = logging.getLogger("discord.perspective")
 
 
 # There should be a file called 'tokens.json' inside the same folder as this file
@@ -11,7 +31,19 @@ if not os.path.isfile(token_path):
 with open(token_path) as f:
     # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
     tokens = json.load(f)
-    perspective_token = tokens["perspective-api-key"]
+    perspective_token = tokens.get("perspective-api-key")
+    # Queries per second allowed by the Perspective API quota. The default quota is 1.
+    perspective_qps = tokens.get("perspective-qps", 1)
+    # Which backend scores messages: "perspective" (default) or "local"
+    backend_name = tokens.get("scoring-backend", "perspective")
+    # Directory the notebook's `save_pretrained` wrote the model to
+    local_model_path = tokens.get("local-model-path", "cyberbullying_model")
+    # Model written by `export_model.py`
+    local_onnx_path = tokens.get("local-onnx-path", "cyberbullying_model.int8.onnx")
+    # Worker processes running a local model. 0 runs it in a thread of the bot's process.
+    local_workers = tokens.get("local-workers", 0)
+    # Model written by `prefilter.py`. The cascade is disabled if the file is missing.
+    prefilter_path = tokens.get("prefilter-path", "prefilter.json")
 
 
 # These are the attributes that will be checked by the API.
@@ -24,9 +56,388 @@ requestedAttributes = {
     "THREAT": {},
 }
 
+ANALYZE_URL = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
+MAX_CONNECTIONS = 20  # Size of the aiohttp connection pool
+KEEPALIVE_TIMEOUT = 60  # Seconds an idle connection is kept open
+REQUEST_TIMEOUT = 10  # Seconds before an async request is abandoned
+FALLBACK_WORKERS = 4  # Threads available to the synchronous fallback
+BATCH_WINDOW = 0.02  # Seconds the batcher waits for more messages
+BATCH_SIZE = 16  # Maximum number of messages per batch
+CACHE_SIZE = 10000  # Maximum number of cached scores
+CACHE_TTL = 6 * 60 * 60  # Seconds a cached score stays valid
+CACHE_PATH = (
+    "score_cache.json"  # Where the cache is persisted. None disables persistence.
+)
+# Messages the prefilter scores below this are never sent to the backend.
+# Must stay well below ModBot.AUTOREPORT_THRESHOLD.
+PREFILTER_CUTOFF = 0.05
+BATCHES_PER_WORKER = (
+    2  # Batches queued per worker process before the pool counts as saturated
+)
+MAX_RATE_LIMIT_DELAY = (
+    5  # Seconds a request may wait for the rate limiter before it is deferred
+)
+MAX_RETRIES = 3  # Retries of a request after a transient error
+RETRY_BASE_DELAY = (
+    0.5  # Seconds before the first retry, doubled for every further retry
+)
+RETRY_MAX_DELAY = 8  # Longest wait between retries
+BREAKER_FAILURE_THRESHOLD = 5  # Failures in a row that open the circuit breaker
+BREAKER_RESET_TIMEOUT = (
+    30  # Seconds the circuit breaker stays open before probing again
+)
+
+
+# The discovery client is expensive to build (it fetches the discovery document
+# over the network), so we build it once and reuse it.
+# httplib2 is not thread safe, so every fallback thread gets its own client.
+_local = threading.local()
+_executor = ThreadPoolExecutor(
+    max_workers=FALLBACK_WORKERS, thread_name_prefix="perspective"
+)
+_session: aiohttp.ClientSession = None
+
+# Identical texts (spam raids, copy-paste harassment, reports of scored messages)
+# are only scored once.
+score_cache = ScoreCache(CACHE_SIZE, CACHE_TTL, CACHE_PATH)
+
+# Cheap first tier of the scoring cascade
+prefilter = Prefilter.load(prefilter_path) if os.path.isfile(prefilter_path) else None
+cascade_statistics = CascadeStatistics()
+
+# Keep within the quota and stop calling the API while it is failing
+rate_limiter = TokenBucket(perspective_qps, max(perspective_qps, 1))
+circuit_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+call_statistics = CallStatistics()
+
+
+def share_quota(processes: int):
+    """Splits the Perspective quota evenly between `processes` bot processes using the same key."""
+    global rate_limiter
+    qps = perspective_qps / processes
+    rate_limiter = TokenBucket(qps, max(qps, 1))
+
+
+class DegradedScore(float):
+    """A rough score from the prefilter, used while the backend is saturated.
+
+    The prefilter is not precise enough to punish anyone, so these scores may only
+    lead to auto-reports, never to strikes or bans.
+    """
+
+
+class TransientError(Exception):
+    """The API answered with a status that is worth retrying."""
+
+
+def get_client():
+    """Returns the long-lived Perspective API client, building it on first use."""
+    client = getattr(_local, "client", None)
+    if client is None:
+        client = discovery.build(
+            "commentanalyzer",
+            "v1alpha1",
+            developerKey=perspective_token,
+            discoveryServiceUrl="https://commentanalyzer.googleapis.com/$discovery/rest?version=v1alpha1",
+            static_discovery=False,
+        )
+        _local.client = client
+    return client
+
+
+def reset_client():
+    """Drops the cached client so that the next call rebuilds it."""
+    client = getattr(_local, "client", None)
+    if client is not None:
+        client.close()
+        _local.client = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the pooled aiohttp session, opening it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        )
+    return _session
+
+
+def build_request(text: str) -> dict:
+    """Builds the body of an analyze request for `text`."""
+    # Convert Unicode characters to ascii characters.
+    # This aims to prevent adversarial unicode texts.
+    return {
+        "comment": {"text": unidecode(text)},
+        "requestedAttributes": requestedAttributes,
+    }
+
+
+def request_score(text: str) -> float:
+    """Scores `text` with the synchronous client. Bypasses the cache."""
+    analyze_request = build_request(text)
+    try:
+        response = get_client().comments().analyze(body=analyze_request).execute()
+    except Exception:
+        # The client might be in a broken state (e.g. a dropped connection).
+        # Rebuild it once and retry before giving up.
+        reset_client()
+        response = get_client().comments().analyze(body=analyze_request).execute()
+    return analyze_scores(response)
+
+
+async def request_score_async(text: str) -> float:
+    """Scores `text` without blocking the event loop. Bypasses the cache.
+
+    Uses a pooled aiohttp session and stays within `perspective_qps`.
+    Rate limit responses, server errors and timeouts are retried with jittered backoff.
+    Raises ScoringUnavailable if the API can't score `text` now.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if await rate_limiter.acquire(MAX_RATE_LIMIT_DELAY):
+            call_statistics.throttled += 1
+        try:
+            async with get_session().post(
+                ANALYZE_URL,
+                params={"key": perspective_token},
+                json=build_request(text),
+            ) as resp:
+                if resp.status == 429 or resp.status >= 500:
+                    raise TransientError(f"status {resp.status}")
+                # Other errors, e.g. unsupported languages, won't go away by retrying.
+                resp.raise_for_status()
+                response = await resp.json()
+        except (
+            TransientError,
+            aiohttp.ClientConnectionError,
+            asyncio.TimeoutError,
+        ) as e:
+            circuit_breaker.record_failure()
+            if attempt == MAX_RETRIES or circuit_breaker.is_open():
+                call_statistics.failed += 1
+                raise ScoringUnavailable(f"Perspective API: {e!r}") from e
+            call_statistics.retried += 1
+            await asyncio.sleep(backoff(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY))
+            continue
+        circuit_breaker.record_success()
+        return analyze_scores(response)
+
+
+class ScoringBackend:
+    """Interface of everything that turns texts into concern scores.
+
+    A concern score is the probability between 0 and 1 that a text is harassment.
+    Backends receive the raw texts and handle unicode conversion themselves.
+    """
+
+    def predict(self, texts: List[str]) -> List[float]:
+        """Scores `texts`. This call blocks."""
+        raise NotImplementedError
+
+    async def predict_async(self, texts: List[str]) -> List[float]:
+        """Scores `texts` without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, self.predict, texts)
+
+    async def predict_each_async(
+        self, texts: List[str]
+    ) -> List[Union[float, BaseException]]:
+        """Like `predict_async`, but returns the score or the error of every text,
+        so that a text that can't be scored doesn't fail the others.
+        """
+        try:
+            return await self.predict_async(texts)
+        except Exception as e:
+            return [e] * len(texts)
+
+    def saturated(self) -> bool:
+        """Whether the backend already has as much work as it can handle."""
+        return False
+
+    def available(self) -> bool:
+        """Whether the backend can be called at all right now."""
+        return True
+
+    async def warm_up(self):
+        """Prepares the backend, so that the first scored message doesn't pay for it."""
+
+    async def close(self):
+        """Releases all resources held by the backend."""
+
+
+class PerspectiveBackend(ScoringBackend):
+    """Scores texts with Google's Perspective API."""
+
+    def predict(self, texts: List[str]) -> List[float]:
+        return [request_score(text) for text in texts]
+
+    async def predict_async(self, texts: List[str]) -> List[float]:
+        return raise_first_error(await self.predict_each_async(texts))
+
+    async def predict_each_async(
+        self, texts: List[str]
+    ) -> List[Union[float, BaseException]]:
+        # The Perspective API only analyzes one comment per request,
+        # so the requests are sent concurrently over the pooled session.
+        return list(
+            await asyncio.gather(
+                *(request_score_async(t) for t in texts), return_exceptions=True
+            )
+        )
+
+    def available(self) -> bool:
+        return circuit_breaker.allow()
+
+    async def warm_up(self):
+        # Opens a pooled connection to the API. The response doesn't matter and no quota is used.
+        try:
+            async with get_session().head(ANALYZE_URL):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warning("Couldn't connect to the Perspective API ahead of time")
+
+    async def close(self):
+        global _session
+        if _session is not None:
+            await _session.close()
+            _session = None
+
+
+class LocalModelBackend(ScoringBackend):
+    """Scores texts with the model trained in `cyberbullying_classifier.ipynb`.
+
+    The model is loaded once and runs on the CPU, see `local_model.py`.
+    """
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        # Only one forward pass runs at a time, the model parallelizes within it.
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="local-model"
+        )
+
+    def predict(self, texts: List[str]) -> List[float]:
+        return self.scorer.predict(texts)
+
+    async def predict_async(self, texts: List[str]) -> List[float]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.predict, texts)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class ProcessPoolBackend(ScoringBackend):
+    """Scores texts with a local model running in a pool of worker processes.
+
+    Every worker loads the model once, see `scoring_pool.py`. Batches are sent to the
+    workers over pipes. Once `max_in_flight` batches are queued, the backend reports
+    itself as saturated and `analyze_each_async` falls back to the prefilter, or
+    defers the texts if there is no prefilter.
+    """
+
+    def __init__(self, variant: str, path: str, workers: int):
+        self.variant = variant
+        self.path = path
+        self.workers = workers
+        self.max_in_flight = workers * BATCHES_PER_WORKER
+        self.in_flight = 0  # Batches sent to the pool and not answered yet
+        self.pool = self.create_pool()
+
+    def create_pool(self) -> ProcessPoolExecutor:
+        # Forking a process with running threads and an event loop is unsafe
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=scoring_pool.load_scorer,
+            initargs=(self.variant, self.path),
+        )
+
+    def predict(self, texts: List[str]) -> List[float]:
+        return self.pool.submit(scoring_pool.predict, texts).result()
+
+    async def predict_async(self, texts: List[str]) -> List[float]:
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            return await loop.run_in_executor(self.pool, scoring_pool.predict, texts)
+        except BrokenProcessPool:
+            # A worker died, e.g. because it ran out of memory. Start over with fresh workers.
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.create_pool()
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def saturated(self) -> bool:
+        return self.in_flight >= self.max_in_flight
+
+    async def warm_up(self):
+        # Workers start and load the model when they receive their first batch
+        await asyncio.gather(*(self.predict_async([""]) for _ in range(self.workers)))
+
+    async def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+LOCAL_VARIANTS = {"local": "fp32", "local-int8": "int8", "local-onnx": "onnx"}
+
+
+def create_backend(name: str) -> ScoringBackend:
+    """Creates the scoring backend called `name`."""
+    if name == "perspective":
+        return PerspectiveBackend()
+    if name in LOCAL_VARIANTS and local_workers > 0:
+        variant = LOCAL_VARIANTS[name]
+        path = local_onnx_path if variant == "onnx" else local_model_path
+        return ProcessPoolBackend(variant, path, local_workers)
+    # Only import the heavy dependencies if a local backend is used.
+    if name == "local":
+        from local_model import BertScorer
+
+        return LocalModelBackend(BertScorer(local_model_path))
+    if name == "local-int8":
+        from local_model import BertScorer
+
+        return LocalModelBackend(BertScorer(local_model_path, quantize=True))
+    if name == "local-onnx":
+        from local_model import OnnxScorer
+
+        return LocalModelBackend(OnnxScorer(local_onnx_path))
+    raise Exception(f"Unknown scoring backend {name}!")
+
+
+_backend: ScoringBackend = None
+
+
+def get_backend() -> ScoringBackend:
+    """Returns the configured scoring backend, creating it on first use."""
+    global _backend
+    if _backend is None:
+        _backend = create_backend(backend_name)
+    return _backend
+
+
+async def warm_up():
+    """Builds the backend ahead of time so the first scored message doesn't pay for it."""
+    await get_backend().warm_up()
+
+
+async def close():
+    """Releases the backend and the fallback threads."""
+    if _backend is not None:
+        await _backend.close()
+    _executor.shutdown(wait=False)
+
 
 def analyze_text(text: str) -> float:
-    """Given a piece of text, returns the probability the text is harassment according to the Perspective API.
+    """Given a piece of text, returns the probability the text is harassment according to the configured backend.
+
+    This call blocks. Use `analyze_text_async` from within the bot.
 
     Args:
         text (str): the text to analyze
@@ -34,24 +445,142 @@ def analyze_text(text: str) -> float:
     Returns:
         float: the probability the string is harassment
     """
-    # Convert Unicode characters to ascii characters.
-    # This aims to prevent adversarial unicode texts.
-    ascii_text = unidecode(text)
-
-    # Open socket for request
-    with discovery.build(
-        "commentanalyzer",
-        "v1alpha1",
-        developerKey=perspective_token,
-        discoveryServiceUrl="https://commentanalyzer.googleapis.com/$discovery/rest?version=v1alpha1",
-        static_discovery=False,
-    ) as client:
-        analyze_request = {
-            "comment": {"text": ascii_text},
-            "requestedAttributes": requestedAttributes,
-        }
-        response = client.comments().analyze(body=analyze_request).execute()
-        return analyze_scores(response)
+    score = score_cache.get(text)
+    if score is None:
+        score = get_backend().predict([text])[0]
+        score_cache.put(text, score)
+    return score
+
+
+async def analyze_text_async(text: str) -> float:
+    """Same as `analyze_text`, but does not block the event loop."""
+    return (await analyze_batch_async([text]))[0]
+
+
+def raise_first_error(results: list) -> list:
+    """Returns `results` if none of them is an exception, otherwise raises the first one."""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def analyze_batch_async(texts: List[str]) -> List[float]:
+    """Scores several texts at once. Raises the first error if any text can't be scored."""
+    return raise_first_error(await analyze_each_async(texts))
+
+
+async def analyze_each_async(texts: List[str]) -> List[Union[float, BaseException]]:
+    """Scores several texts at once. Returns the score or the error of every text.
+
+    Cached and duplicate texts are only sent to the backend once.
+    Texts are scored by a cascade: messages without letters and messages the prefilter
+    considers obviously benign are resolved locally, only the rest reach the backend.
+    Only successful scores are cached.
+    Raises ScoringUnavailable if the backend can't be called right now.
+    """
+    scores = {}
+    prefilter_scores = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        score = score_cache.get(text)
+        if score is not None:
+            scores[text] = score
+            continue
+        if is_trivial(text):
+            cascade_statistics.add("trivial")
+            scores[text] = 0
+            continue
+        if prefilter is not None:
+            score = prefilter.predict(text)
+            if score < PREFILTER_CUTOFF:
+                cascade_statistics.add("prefilter")
+                scores[text] = score
+                continue
+            prefilter_scores[text] = score
+        missing.append(text)
+    if not missing:
+        return [scores[text] for text in texts]
+    backend = get_backend()
+    if not backend.available():
+        raise ScoringUnavailable("circuit breaker open")
+    if backend.saturated():
+        # Don't queue more work than the backend can handle. The prefilter's
+        # score is rough, so it isn't cached. Without a prefilter, the texts wait.
+        for text in missing:
+            if prefilter is None:
+                scores[text] = ScoringUnavailable("backend saturated")
+            else:
+                cascade_statistics.add("degraded")
+                scores[text] = DegradedScore(prefilter_scores[text])
+        return [scores[text] for text in texts]
+    for text in missing:
+        cascade_statistics.add("model")
+    for text, score in zip(missing, await backend.predict_each_async(missing)):
+        if not isinstance(score, BaseException):
+            score_cache.put(text, score)
+        scores[text] = score
+    return [scores[text] for text in texts]
+
+
+class ScoreBatcher:
+    """Coalesces messages arriving within a short window into a single batch.
+
+    Callers await `score` and get back the score of their own message, or its error.
+    A batch is sent once `max_size` messages are waiting or `window` seconds have passed.
+    """
+
+    def __init__(self, window: float = BATCH_WINDOW, max_size: int = BATCH_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self.pending = []  # List of (text, future) waiting to be sent
+        self.flush_handle: asyncio.TimerHandle = None
+        self.tasks = set()  # Keeps a reference to the batches in flight
+        self.batches_sent = 0
+        self.texts_scored = 0
+
+    async def score(self, text: str) -> float:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        """Sends all pending messages as one batch."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self.send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch):
+        texts = [text for (text, _) in batch]
+        self.batches_sent += 1
+        self.texts_scored += len(texts)
+        try:
+            results = await analyze_each_async(texts)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def average_batch_size(self) -> float:
+        if self.batches_sent == 0:
+            return 0
+        return round(self.texts_scored / self.batches_sent, 2)
 
 
 def analyze_scores(response) -> float:
@@ -0,0 +1,139 @@
+from unidecode import unidecode
+from typing import List, Optional
+import argparse
+import csv
+import json
+import math
+import random
+import re
+import zlib
+
+NUM_FEATURES = 2**18  # Size of the hashed feature space
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def features(text: str) -> List[int]:
+    """Hashes the word unigrams and bigrams of `text` into feature indices."""
+    words = WORD_PATTERN.findall(unidecode(text).lower())
+    grams = words + [a + " " + b for a, b in zip(words, words[1:])]
+    # crc32 is stable across processes, unlike `hash`.
+    return [zlib.crc32(g.encode("utf-8")) % NUM_FEATURES for g in grams]
+
+
+def is_trivial(text: str) -> bool:
+    """Messages without any letters (emoji, punctuation, numbers) can't be harassment."""
+    return not any(c.isalpha() for c in unidecode(text))
+
+
+class Prefilter:
+    """Cheap hashed n-gram logistic regression that clears obviously benign messages.
+
+    Trained on the `cyberbullying_tweets.csv` dataset used in `cyberbullying_classifier.ipynb`.
+    """
+
+    def __init__(self, weights: Optional[dict] = None, bias: float = 0):
+        self.weights = weights if weights is not None else {}  # feature index -> weight
+        self.bias = bias
+
+    def predict(self, text: str) -> float:
+        """Returns the probability that `text` is harassment."""
+        if is_trivial(text):
+            return 0
+        z = self.bias + sum(self.weights.get(f, 0) for f in features(text))
+        return 1 / (1 + math.exp(-max(min(z, 30), -30)))
+
+    def train(self, texts: List[str], labels: List[int], epochs: int = 5, rate=0.1):
+        """Fits the weights with plain stochastic gradient descent."""
+        examples = [(features(t), l) for t, l in zip(texts, labels)]
+        rng = random.Random(0)
+        for _ in range(epochs):
+            rng.shuffle(examples)
+            for feats, label in examples:
+                z = self.bias + sum(self.weights.get(f, 0) for f in feats)
+                gradient = 1 / (1 + math.exp(-max(min(z, 30), -30))) - label
+                self.bias -= rate * gradient
+                for f in feats:
+                    self.weights[f] = self.weights.get(f, 0) - rate * gradient
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"bias": self.bias, "weights": self.weights}, f)
+
+    @staticmethod
+    def load(path: str) -> "Prefilter":
+        with open(path) as f:
+            data = json.load(f)
+        # JSON keys are strings
+        weights = {int(k): v for k, v in data["weights"].items()}
+        return Prefilter(weights, data["bias"])
+
+
+class CascadeStatistics:
+    """Counts which tier of the scoring cascade resolved each message."""
+
+    # "degraded": the prefilter's score was used because the backend was saturated
+    TIERS = ["trivial", "prefilter", "model", "degraded"]
+
+    def __init__(self) -> None:
+        self.resolved = {tier: 0 for tier in self.TIERS}
+
+    def add(self, tier: str):
+        self.resolved[tier] += 1
+
+    def overview(self) -> str:
+        total = sum(self.resolved.values())
+        overview = "Scoring cascade (which tier resolved the message):\n```"
+        for tier in self.TIERS:
+            share = 0 if total == 0 else round(self.resolved[tier] / total * 100, 2)
+            overview += "\n{:<10s}{:>8d} ({}%)".format(tier, self.resolved[tier], share)
+        overview += "\n```"
+        return overview
+
+
+def load_dataset(csv_path: str):
+    """Loads the tweets and the binary labels the notebook uses."""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    texts = [row["tweet_text"] for row in rows]
+    labels = [int(row["cyberbullying_type"] != "not_cyberbullying") for row in rows]
+    return texts, labels
+
+
+def split(texts, labels, test_size=0.2):
+    """Deterministic train/test split."""
+    order = list(range(len(texts)))
+    random.Random(42).shuffle(order)
+    cut = int(len(order) * (1 - test_size))
+    train, test = order[:cut], order[cut:]
+    return (
+        [texts[i] for i in train],
+        [labels[i] for i in train],
+        [texts[i] for i in test],
+        [labels[i] for i in test],
+    )
+
+
+def evaluate(prefilter: Prefilter, texts, labels, cutoff: float):
+    """Prints how many messages the prefilter clears at `cutoff` and how many harassing ones it misses."""
+    cleared = [prefilter.predict(t) < cutoff for t in texts]
+    missed = sum(c and l for c, l in zip(cleared, labels))
+    print(
+        f"cutoff {cutoff}: clears {round(sum(cleared) / len(texts) * 100, 2)}% of messages, "
+        + f"misses {missed}/{sum(labels)} harassing messages "
+        + f"(recall {round((1 - missed / max(sum(labels), 1)) * 100, 2)}%)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_path", help="cyberbullying_tweets.csv")
+    parser.add_argument("--output", default="prefilter.json")
+    args = parser.parse_args()
+
+    texts, labels = load_dataset(args.csv_path)
+    train_texts, train_labels, test_texts, test_labels = split(texts, labels)
+    prefilter = Prefilter()
+    prefilter.train(train_texts, train_labels)
+    prefilter.save(args.output)
+    for cutoff in [0.01, 0.02, 0.05, 0.1, 0.2]:
+        evaluate(prefilter, test_texts, test_labels, cutoff)
@@ -8,8 +8,13 @@ from report_views import (
     HARASSMENT_TYPES,
 )
 from typing import Optional, List, Union
-from datetime import date
+from datetime import datetime
+import asyncio
+import itertools
+import math
+import time
 import perspective
+from throttling import ScoringUnavailable
 
 
 class State(Enum):
@@ -22,11 +27,33 @@ class State(Enum):
     REPORT_COMPLETE = auto()
 
 
+# Orders reports submitted at the same instant
+_submission_counter = itertools.count()
+
+# Priority added each time the number of reports of a message doubles
+DUPLICATE_PRIORITY = 0.1
+
+
+def report_priority(score: float, reports: int) -> float:
+    """Queue priority of a message with concern score `score` that was reported `reports` times."""
+    return score + DUPLICATE_PRIORITY * math.log2(reports)
+
+
 class Report:
     START_KEYWORD = "report"
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
 
+    SCORE_DEADLINE = (
+        3  # Seconds to wait for the scores before the report is queued anyway
+    )
+    RESCORE_INTERVAL = (
+        5  # Seconds between attempts to score messages the backend couldn't score
+    )
+    LISTED_REPORTERS = (
+        10  # Reporters shown to the moderators, the rest are only counted
+    )
+
     SUBMIT_MSG = "Thank you for reporting. We take your report very seriously. Our content moderation team will review your report. Further action might include temporary or permanent account suspension."
 
     def __init__(self, client):
@@ -34,16 +61,22 @@ class Report:
         self.state = State.REPORT_START
         # The ModBot
         self.client = client
+        self.guild = None  # GuildState of the reported message's guild
         # State for filing a report
         self.author = None  # Author of the report
+        self.other_reporters = []  # Users who reported the same message later
         self.message: discord.Message = None  # Reported message
         self.abuse_type: ABUSE_TYPES = None
         self.harassment_types: List[HARASSMENT_TYPES] = []
         self.target = ""  # Target of the abuse
-        self.date_submitted = None
+        self.date_submitted = None  # Wall clock time, for display
+        self.time_submitted = None  # Monotonic time, for ordering and queue ages
+        self.sequence = None  # Breaks ties between equal submission times
         self.additional_msgs: List[discord.Message] = []
         self.additional_info: Optional[str] = None
         self.score: float = 0
+        self.partial_score = False  # Some messages weren't scored yet when queued
+        self.journal_id = None  # Id of the report in its queue's journal
 
     async def handle_message(self, message):
         """
@@ -70,7 +103,22 @@ class Report:
             if type(msg) == str:
                 return [msg]
 
-            if self.client.is_banned(msg.author):
+            if self.client.owns_guild(msg.guild.id):
+                guild = self.client.guild_state(msg.guild)
+                if guild is None:
+                    return [
+                        "I'm not moderating the guild of this message.",
+                        "Please provide a different message.",
+                    ]
+                banned = guild.is_banned(msg.author)
+            else:
+                # Another process moderates this guild. The report is forwarded once it's complete.
+                guild = None
+                banned = await asyncio.to_thread(
+                    self.client.store.is_banned, msg.guild.id, msg.author.id
+                )
+
+            if banned:
                 return [
                     "This user is already banned.",
                     "Please provide a different message.",
@@ -78,6 +126,7 @@ class Report:
 
             # Here we've found the message - let's enter our View flow.
             self.state = State.IN_VIEW
+            self.guild = guild
             self.message = msg
             return [
                 "I found this message:",
@@ -89,6 +138,11 @@ class Report:
             msg = await self.parse_msg(message)
             if type(msg) == str:
                 return [msg]
+            if msg.guild.id != self.message.guild.id:
+                return [
+                    "All messages of a report must be from the same guild.",
+                    "Please provide a different message.",
+                ]
             self.additional_msgs.append(msg)
             self.state = State.IN_VIEW
             return [
@@ -102,7 +156,7 @@ class Report:
 
         if self.state == State.GETTING_EXTRA_INFO:
             self.additional_info = message.content
-            self.date_submitted = date.today()
+            self.mark_submitted()
             self.state = State.REPORT_COMPLETE
             return [("", self.create_submit_embed())]
 
@@ -121,17 +175,50 @@ class Report:
         if not m:
             return "I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."
         guild = self.client.get_guild(int(m.group(1)))
-        if not guild:
+        if guild:
+            channel = guild.get_channel(int(m.group(2)))
+        elif not self.client.owns_guild(int(m.group(1))):
+            # The guild belongs to a shard of another process, so it isn't cached here
+            channel = await self.fetch_channel(self.client, int(m.group(2)))
+        else:
             return "I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."
-        channel = guild.get_channel(int(m.group(2)))
         if not channel:
             return "It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."
+        key = (int(m.group(1)), channel.id, int(m.group(3)))
         try:
-            message = await channel.fetch_message(int(m.group(3)))
+            # Usually the bot has just seen the message, or someone else reported it already
+            message = await self.client.message_cache.fetch(
+                key, lambda: channel.fetch_message(key[2])
+            )
         except discord.errors.NotFound:
             return "It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."
         return message
 
+    @staticmethod
+    async def fetch_channel(client, channel_id: int):
+        """Returns the channel `channel_id`, asking Discord if it isn't cached. Returns None if it can't be accessed."""
+        channel = client.get_channel(channel_id)
+        if channel is not None:
+            return channel
+        try:
+            return await client.fetch_channel(channel_id)
+        except (discord.errors.NotFound, discord.errors.Forbidden):
+            return None
+
+    @staticmethod
+    async def fetch_message(client, channel_id: int, message_id: int):
+        """Returns the message `message_id` in channel `channel_id`, or None if it can't be found."""
+        channel = await Report.fetch_channel(client, channel_id)
+        if channel is None:
+            return None
+        try:
+            return await client.message_cache.fetch(
+                (channel.guild.id, channel_id, message_id),
+                lambda: channel.fetch_message(message_id),
+            )
+        except discord.errors.NotFound:
+            return None
+
     def report_canceled(self):
         return self.state == State.REPORT_CANCELED
 
@@ -153,8 +240,9 @@ class Report:
 
     def report_info(self):
         """Info provided to the moderators for review."""
+        statistics = self.guild.statistics
         return (
-            f"User {self.author.name} reported the following message on {self.date_submitted}:\n"
+            f"User {self.author.name} reported the following message on {self.date_submitted:%Y-%m-%d %H:%M:%S}:\n"
             + f"```{self.message.author.name}: {self.message.content}```\n"
             + "-------- Report Info --------\n"
             + f"Abuse Type: {self.abuse_type}\n"
@@ -163,25 +251,211 @@ class Report:
             + f"Additional Msgs: {self.format_extra_msgs()}\n"
             + f"Additional Info: {self.additional_info}\n"
             + f"Concern Score: {round(self.score * 100, 2)}\n"
-            + f"Average concern score of message author: {self.client.statistics.get_average_sentiment_score(self.message.author.id)}%\n"
+            + f"Average concern score of message author: {statistics.get_average_sentiment_score(self.message.author.id)}%\n"
+            + f"Recent concern score of message author: {statistics.get_recent_sentiment_score(self.message.author.id)}% "
+            + f"(decayed {statistics.get_decayed_sentiment_score(self.message.author.id)}%, "
+            + f"peak {statistics.get_peak_sentiment_score(self.message.author.id)}%)\n"
             + "-------- Reporter Info --------\n"
-            + f"Average report accuracy: {self.client.statistics.get_average_report_accuracy(self.author.id)}%"
+            + self.reporter_info()
         )
 
+    async def load_statistics(self):
+        """Loads the statistics that report_info shows back into memory, if they were evicted."""
+        user_ids = [self.message.author.id] + [r.id for r in self.reporters()]
+        await self.guild.statistics.load_users_async(user_ids)
+
+    def reporter_info(self) -> str:
+        statistics = self.guild.statistics
+        reporters = self.reporters()
+        if len(reporters) == 1:
+            return f"Average report accuracy: {statistics.get_average_report_accuracy(self.author.id)}%"
+        lines = [f"Reported by {len(reporters)} users. Average report accuracy:"]
+        for reporter in reporters[: self.LISTED_REPORTERS]:
+            lines.append(
+                f"{reporter.name}: {statistics.get_average_report_accuracy(reporter.id)}%"
+            )
+        if len(reporters) > self.LISTED_REPORTERS:
+            lines.append(f"... and {len(reporters) - self.LISTED_REPORTERS} more")
+        return "\n".join(lines)
+
     async def finish_report(self):
         """Finishes the report by setting the type to complete and calling the client's clean up funciton."""
         self.state = State.REPORT_COMPLETE
-        self.date_submitted = date.today()
-        self.client.statistics.increment_reports_against(self.message.author.id)
-        self.client.statistics.increment_reports_sent(self.author.id)
-        score = perspective.analyze_text(self.message.content)
-        for msg in self.additional_msgs:
-            eval = perspective.analyze_text(msg.content)
-            if eval > score:
-                score = eval
-        self.score = score
+        self.mark_submitted()
+        if self.guild is not None:
+            # Forwarded reports are counted by the process that receives them
+            await self.load_statistics()
+            self.guild.statistics.increment_reports_against(self.message.author.id)
+            self.guild.statistics.increment_reports_sent(self.author.id)
+            if (
+                self.guild.unreviewed_reports.find(self.reported_message_id())
+                is not None
+            ):
+                # The message is queued already. This report is merged into it, and only
+                # its additional messages are scored.
+                if self.additional_msgs:
+                    self.client.run_in_background(
+                        self.raise_merged_score(
+                            self.score_messages(self.additional_msgs)
+                        )
+                    )
+                await self.client.clean_up_report(self.author.id)
+                return
+        # Score all messages concurrently, but don't let the reporter wait forever.
+        messages = [self.message] + self.additional_msgs
+        tasks = self.score_messages(messages)
+        _, pending = await asyncio.wait(tasks, timeout=self.SCORE_DEADLINE)
+        self.score = self.max_score(tasks)
+        self.partial_score = bool(pending) or self.unavailable(tasks)
+        if self.partial_score and self.guild is not None:
+            # Queue the report with the partial score and update it once all scores are in.
+            # Forwarded reports are rescored by the process that receives them.
+            self.client.run_in_background(self.rescore(messages, tasks))
         await self.client.clean_up_report(self.author.id)
 
+    @staticmethod
+    def score_messages(messages) -> list:
+        return [
+            asyncio.ensure_future(perspective.analyze_text_async(msg.content))
+            for msg in messages
+        ]
+
+    async def rescore(self, messages, tasks):
+        """Waits for the remaining scores and raises the priority of the report if necessary.
+        Messages the backend was unable to score are tried again while the report is queued.
+        """
+        while True:
+            await asyncio.wait(tasks)
+            # By message, not by report: this one might have been merged into another meanwhile
+            queue = self.guild.unreviewed_reports
+            queue.raise_score(self.reported_message_id(), self.max_score(tasks))
+            messages = [
+                msg
+                for msg, task in zip(messages, tasks)
+                if isinstance(task.exception(), ScoringUnavailable)
+            ]
+            if not messages:
+                return
+            await asyncio.sleep(self.RESCORE_INTERVAL)
+            if queue.find(self.reported_message_id()) is None:
+                return
+            tasks = self.score_messages(messages)
+
+    async def raise_merged_score(self, tasks):
+        """Raises the score of the report this one was merged into, if its additional messages are worse."""
+        await asyncio.wait(tasks)
+        self.guild.unreviewed_reports.raise_score(
+            self.reported_message_id(), self.max_score(tasks)
+        )
+
+    @staticmethod
+    def unavailable(tasks) -> bool:
+        """Whether the backend couldn't score any of the finished tasks for now."""
+        return any(
+            t.done() and isinstance(t.exception(), ScoringUnavailable) for t in tasks
+        )
+
+    @staticmethod
+    def max_score(tasks) -> float:
+        """Highest score among the finished scoring tasks. Failed tasks are ignored."""
+        return max(
+            [t.result() for t in tasks if t.done() and t.exception() is None],
+            default=0,
+        )
+
+    def to_dict(self) -> dict:
+        """The report with all Discord objects replaced by their IDs."""
+        return {
+            "author_id": self.author.id,
+            "other_reporter_ids": [user.id for user in self.other_reporters],
+            "reported_user_id": self.message.author.id,
+            "channel_id": self.message.channel.id,
+            "message_id": self.message.id,
+            "additional_msgs": [[m.channel.id, m.id] for m in self.additional_msgs],
+            "abuse_type": self.abuse_type,
+            "harassment_types": list(self.harassment_types),
+            "target": self.target,
+            "additional_info": self.additional_info,
+            "score": self.score,
+            "partial_score": self.partial_score,
+            "date_submitted": self.date_submitted.timestamp(),
+        }
+
+    @staticmethod
+    async def restore(client, guild, data: dict) -> Optional["Report"]:
+        """Rebuilds a report written by `to_dict`. Returns None if the reported message was deleted."""
+        report = Report(client)
+        report.guild = guild
+        report.author = client.get_user(data["author_id"]) or await client.fetch_user(
+            data["author_id"]
+        )
+        report.message = await Report.fetch_message(
+            client, data["channel_id"], data["message_id"]
+        )
+        if report.message is None:
+            return None
+        for user_id in data.get("other_reporter_ids", []):
+            report.other_reporters.append(
+                client.get_user(user_id) or await client.fetch_user(user_id)
+            )
+        for channel_id, message_id in data["additional_msgs"]:
+            msg = await Report.fetch_message(client, channel_id, message_id)
+            if msg is not None:
+                report.additional_msgs.append(msg)
+        report.abuse_type = data["abuse_type"]
+        report.harassment_types = data["harassment_types"]
+        report.target = data["target"]
+        report.additional_info = data["additional_info"]
+        report.score = data["score"]
+        report.partial_score = data.get("partial_score", False)
+        report.state = State.REPORT_COMPLETE
+        report.mark_submitted()
+        # Keep the age of the report
+        report.date_submitted = datetime.fromtimestamp(data["date_submitted"])
+        report.time_submitted -= max(time.time() - data["date_submitted"], 0)
+        return report
+
+    def mark_submitted(self):
+        """Records when the report was submitted."""
+        self.date_submitted = datetime.now()
+        self.time_submitted = time.monotonic()
+        self.sequence = next(_submission_counter)
+
+    def submission_key(self):
+        """Orders reports by submission, oldest first. Never ties."""
+        return (self.time_submitted, self.sequence)
+
+    def reported_user_id(self) -> int:
+        return self.message.author.id
+
+    def reported_message_id(self) -> int:
+        return self.message.id
+
+    def reporters(self) -> list:
+        """Everyone who reported the message, in order."""
+        return [self.author] + self.other_reporters
+
+    def human_reporters(self) -> list:
+        """The reporters without the bot, which files the auto-reports."""
+        return [r for r in self.reporters() if r.id != self.client.user.id]
+
+    def add_reporter(self, user) -> bool:
+        """Records that `user` reported the message too. Returns False if they had already."""
+        if any(reporter.id == user.id for reporter in self.reporters()):
+            return False
+        self.other_reporters.append(user)
+        return True
+
+    def add_messages(self, messages) -> bool:
+        """Adds the additional messages of a merged report. Returns whether any were new."""
+        known = {self.message.id} | {msg.id for msg in self.additional_msgs}
+        new = [msg for msg in messages if msg.id not in known]
+        self.additional_msgs.extend(new)
+        return bool(new)
+
+    def priority(self) -> float:
+        return report_priority(self.score, len(self.other_reporters) + 1)
+
     # State setters and getters
     def set_info_state(self):
         self.state = State.GETTING_EXTRA_INFO
@@ -203,9 +477,82 @@ class Report:
 
     # Sorting functions for the class
     def _is_valid_operand(self, other):
-        return hasattr(other, "date_submitted")
+        return hasattr(other, "submission_key")
 
     def __lt__(self, other):
         if not self._is_valid_operand(other):
             return NotImplemented
-        return self.date_submitted < other.date_submitted
+        return self.submission_key() < other.submission_key()
+
+
+class StoredReport:
+    """A report recovered from a queue journal.
+
+    Only holds the IDs written by `Report.to_dict`, so that thousands of reports are
+    recovered without talking to Discord. Resolved into a `Report` when it is reviewed.
+    """
+
+    def __init__(self, journal_id: int, data: dict):
+        self.journal_id = journal_id
+        self.data = data
+        self.date_submitted = datetime.fromtimestamp(data["date_submitted"])
+        self.time_submitted = time.monotonic() - max(
+            time.time() - data["date_submitted"], 0
+        )
+        self.sequence = next(_submission_counter)
+
+    def submission_key(self):
+        return (self.time_submitted, self.sequence)
+
+    def reported_user_id(self) -> int:
+        return self.data["reported_user_id"]
+
+    def reported_message_id(self) -> int:
+        return self.data["message_id"]
+
+    def add_reporter(self, user) -> bool:
+        other_reporter_ids = self.data.get("other_reporter_ids", [])
+        if user.id == self.data["author_id"] or user.id in other_reporter_ids:
+            return False
+        # Replaced, not changed: a compaction might be writing the old dict right now
+        self.data = {**self.data, "other_reporter_ids": other_reporter_ids + [user.id]}
+        return True
+
+    def add_messages(self, messages) -> bool:
+        known = {self.data["message_id"]} | {m for _, m in self.data["additional_msgs"]}
+        new = [[msg.channel.id, msg.id] for msg in messages if msg.id not in known]
+        if new:
+            self.data = {
+                **self.data,
+                "additional_msgs": self.data["additional_msgs"] + new,
+            }
+        return bool(new)
+
+    @property
+    def score(self) -> float:
+        return self.data["score"]
+
+    def set_score(self, score: float):
+        self.data = {**self.data, "score": score}
+
+    def priority(self) -> float:
+        return report_priority(
+            self.data["score"], len(self.data.get("other_reporter_ids", [])) + 1
+        )
+
+    def to_dict(self) -> dict:
+        return self.data
+
+    async def resolve(self, client, guild) -> Optional[Report]:
+        """Fetches the messages and users of the report. Returns None if the reported message was deleted."""
+        report = await Report.restore(client, guild, self.data)
+        if report is None:
+            return None
+        report.journal_id = self.journal_id
+        # Reports merged while the messages were fetched
+        other_reporter_ids = self.data.get("other_reporter_ids", [])
+        for user_id in other_reporter_ids[len(report.other_reporters) :]:
+            report.other_reporters.append(
+                client.get_user(user_id) or await client.fetch_user(user_id)
+            )
+        return report
@@ -0,0 +1,293 @@
+from collections import defaultdict, deque
+import heapq
+import itertools
+import time
+
+
+def percentile(values, p: float) -> float:
+    """Returns the `p`th percentile of the sorted list `values`."""
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
+
+
+class Lease:
+    """A report handed out to a moderator. Returned to the queue unless completed in time."""
+
+    __slots__ = ("lease_id", "score", "report", "holder", "expires", "removed")
+
+    def __init__(self, lease_id: int, score: float, report, holder, expires: float):
+        self.lease_id = lease_id
+        self.score = score
+        self.report = report
+        self.holder = holder  # Id of the moderator reviewing the report
+        self.expires = expires  # Monotonic time the lease runs out
+        # Reports against the reported user were removed, so this one isn't queued again
+        self.removed = False
+
+
+class ReportQueue:
+    """Queue of unreviewed reports, indexed by priority, submission time, reported user and reported message.
+
+    Removed and re-prioritized reports leave tombstones in the heaps,
+    which are skipped when popping and compacted away once they pile up.
+
+    If a journal is given, every report is recorded from `push` until it is `complete`d
+    or removed. Popped and leased reports stay in the journal, so they are queued again
+    after a crash.
+
+    There is at most one report per reported message. Later reports of the same message,
+    even while it is being reviewed, are `merge`d into it instead of being queued again.
+    """
+
+    WAIT_SAMPLES = 1000  # Number of recent time-in-queue samples kept
+
+    def __init__(self, journal=None):
+        self.journal = journal  # QueueJournal or None
+        self.by_priority = []  # Heap of (-score, entry id)
+        self.by_time = []  # Heap of (submission key, entry id)
+        self.reports = {}  # Entry id -> report, only for reports still in the queue
+        self.scores = {}  # Entry id -> current score
+        self.entry_ids = {}  # Report -> entry id
+        self.by_user = defaultdict(set)  # Id of the reported user -> entry ids
+        self.by_message = {}  # Id of the reported message -> queued or leased report
+        self.counter = itertools.count()  # Breaks ties, so reports are never compared
+        self.waits = deque(maxlen=self.WAIT_SAMPLES)  # Seconds popped reports waited
+        self.leases = {}  # Lease id -> active lease
+        self.lease_expiries = (
+            []
+        )  # Heap of (expiry, lease id), may contain finished leases
+
+    def __len__(self):
+        return len(self.reports)
+
+    def __contains__(self, report):
+        return report in self.entry_ids
+
+    def push(self, score: float, report):
+        """Adds a new report."""
+        if self.journal is not None:
+            report.journal_id = self.journal.push(score, report.to_dict())
+        self.insert(score, report)
+
+    def insert(self, score: float, report):
+        """Adds a report that is already journaled."""
+        entry_id = next(self.counter)
+        self.reports[entry_id] = report
+        self.scores[entry_id] = score
+        self.entry_ids[report] = entry_id
+        self.by_user[report.reported_user_id()].add(entry_id)
+        self.by_message.setdefault(report.reported_message_id(), report)
+        heapq.heappush(self.by_priority, (-score, entry_id))
+        heapq.heappush(self.by_time, (report.submission_key(), entry_id))
+
+    def find(self, message_id: int):
+        """Returns the queued or leased report of message `message_id`, or None."""
+        return self.by_message.get(message_id)
+
+    def merge(self, report) -> bool:
+        """Folds `report` into the queued or leased report of the same message, raising its priority.
+        Returns whether there was such a report.
+        """
+        existing = self.by_message.get(report.reported_message_id())
+        if existing is None:
+            return False
+        changed = existing.add_reporter(report.author)
+        changed = existing.add_messages(report.additional_msgs) or changed
+        if report.score > existing.score:
+            existing.set_score(report.score)
+            changed = True
+        if changed:
+            self.update_score(existing, existing.priority())
+        return True
+
+    def raise_score(self, message_id: int, score: float):
+        """Raises the score of the queued or leased report of message `message_id` to `score`."""
+        existing = self.by_message.get(message_id)
+        if existing is not None and score > existing.score:
+            existing.set_score(score)
+            self.update_score(existing, existing.priority())
+
+    def pop_highest_priority(self):
+        """Pops the report with the highest score. Returns (score, report)."""
+        while True:
+            neg_score, entry_id = heapq.heappop(self.by_priority)
+            # Skip removed reports and outdated scores
+            if self.scores.get(entry_id) == -neg_score:
+                return self.pop_entry(entry_id)
+
+    def pop_oldest(self):
+        """Pops the report submitted first. Returns (score, report)."""
+        while True:
+            _, entry_id = heapq.heappop(self.by_time)
+            if entry_id in self.reports:
+                return self.pop_entry(entry_id)
+
+    def pop_entry(self, entry_id):
+        score = self.scores[entry_id]
+        report = self.reports[entry_id]
+        self.remove_entry(entry_id)
+        self.waits.append(time.monotonic() - report.time_submitted)
+        return (score, report)
+
+    def lease_highest_priority(self, holder, timeout: float):
+        """Leases the report with the highest score to `holder`. Returns None if the queue is empty."""
+        if not self.reports:
+            return None
+        return self.lease(*self.pop_highest_priority(), holder, timeout)
+
+    def lease_oldest(self, holder, timeout: float):
+        """Leases the report submitted first to `holder`. Returns None if the queue is empty."""
+        if not self.reports:
+            return None
+        return self.lease(*self.pop_oldest(), holder, timeout)
+
+    def lease(self, score: float, report, holder, timeout: float) -> Lease:
+        lease = Lease(
+            next(self.counter), score, report, holder, time.monotonic() + timeout
+        )
+        self.leases[lease.lease_id] = lease
+        heapq.heappush(self.lease_expiries, (lease.expires, lease.lease_id))
+        return lease
+
+    def replace_leased(self, lease: Lease, report):
+        """Swaps the report of `lease` for `report`, e.g. once it has been fetched from Discord."""
+        if self.by_message.get(lease.report.reported_message_id()) is lease.report:
+            self.by_message[report.reported_message_id()] = report
+        lease.report = report
+
+    def release(self, lease: Lease) -> bool:
+        """Puts a leased report back into the queue. Returns whether the lease was still active.
+
+        Reports against a user removed during the lease are completed instead.
+        """
+        if lease.removed:
+            return self.complete(lease)
+        if self.leases.pop(lease.lease_id, None) is None:
+            return False
+        self.insert(lease.score, lease.report)
+        return True
+
+    def holds(self, lease: Lease) -> bool:
+        """Whether `lease` is still active."""
+        return self.leases.get(lease.lease_id) is lease
+
+    def complete(self, lease: Lease) -> bool:
+        """Marks a leased report as reviewed. Returns whether the lease was still active.
+
+        An expired lease changes nothing: its report went back to the queue and
+        might be under review by another moderator already.
+        """
+        if self.leases.pop(lease.lease_id, None) is None:
+            return False
+        if self.journal is not None:
+            self.journal.remove(lease.report.journal_id)
+        self.forget_message(lease.report)
+        return True
+
+    def reclaim_expired(self):
+        """Returns all reports whose lease expired to the queue. Returns the expired leases."""
+        expired = []
+        now = time.monotonic()
+        while self.lease_expiries and self.lease_expiries[0][0] <= now:
+            _, lease_id = heapq.heappop(self.lease_expiries)
+            lease = self.leases.get(lease_id)
+            if lease is not None:
+                self.release(lease)
+                expired.append(lease)
+        return expired
+
+    def remove(self, report) -> bool:
+        """Removes `report` from the queue. Returns whether it was queued."""
+        if report not in self.entry_ids:
+            return False
+        if self.journal is not None:
+            self.journal.remove(report.journal_id)
+        self.forget_message(report)
+        self.remove_entry(self.entry_ids[report])
+        return True
+
+    def remove_user(self, user_id: int) -> int:
+        """Removes all reports against user `user_id`. Returns how many were removed.
+
+        Leased reports stay with their moderator, but don't go back to the queue.
+        """
+        entry_ids = self.by_user.pop(user_id, set())
+        for entry_id in list(entry_ids):
+            if self.journal is not None:
+                self.journal.remove(self.reports[entry_id].journal_id)
+            self.forget_message(self.reports[entry_id])
+            self.remove_entry(entry_id)
+        leased = 0
+        for lease in self.leases.values():
+            if lease.report.reported_user_id() == user_id and not lease.removed:
+                lease.removed = True
+                leased += 1
+        return len(entry_ids) + leased
+
+    def update_score(self, report, score: float) -> bool:
+        """Re-prioritizes a queued or leased report. Returns whether it was found."""
+        if self.by_message.get(report.reported_message_id()) is not report:
+            return False
+        if self.journal is not None:
+            self.journal.update(report.journal_id, score, report.to_dict())
+        for lease in self.leases.values():
+            if lease.report is report:
+                # Takes effect if the report goes back to the queue
+                lease.score = score
+        if report not in self.entry_ids:
+            return True
+        entry_id = self.entry_ids[report]
+        self.scores[entry_id] = score
+        # The old heap entry becomes a tombstone
+        heapq.heappush(self.by_priority, (-score, entry_id))
+        self.compact()
+        return True
+
+    def forget_message(self, report):
+        message_id = report.reported_message_id()
+        if self.by_message.get(message_id) is report:
+            del self.by_message[message_id]
+
+    def remove_entry(self, entry_id):
+        report = self.reports.pop(entry_id)
+        del self.scores[entry_id]
+        del self.entry_ids[report]
+        user_entries = self.by_user.get(report.reported_user_id())
+        if user_entries is not None:
+            user_entries.discard(entry_id)
+            if not user_entries:
+                del self.by_user[report.reported_user_id()]
+        self.compact()
+
+    def compact(self):
+        """Rebuilds the heaps once most of their entries are tombstones."""
+        if len(self.by_priority) + len(self.by_time) <= 4 * len(self.reports) + 64:
+            return
+        self.by_priority = [(-self.scores[i], i) for i in self.reports]
+        self.by_time = [(r.submission_key(), i) for i, r in self.reports.items()]
+        heapq.heapify(self.by_priority)
+        heapq.heapify(self.by_time)
+
+    def age_overview(self) -> str:
+        """Summarizes how long reports wait in the queue."""
+        now = time.monotonic()
+        ages = sorted(now - r.time_submitted for r in self.reports.values())
+        waits = sorted(self.waits)
+        return (
+            f"There are {len(self)} reports outstanding.\n```"
+            + "\nOutstanding reports:"
+            + f"\n  p50 age: {format_duration(percentile(ages, 50))}"
+            + f"\n  p95 age: {format_duration(percentile(ages, 95))}"
+            + f"\n  oldest:  {format_duration(ages[-1] if ages else 0)}"
+            + f"\nLast {len(waits)} popped reports:"
+            + f"\n  p50 time in queue: {format_duration(percentile(waits, 50))}"
+            + f"\n  p95 time in queue: {format_duration(percentile(waits, 95))}"
+            + "\n```"
+        )
@@ -14,11 +14,14 @@ class Review:
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
 
-    def __init__(self, client):
+    def __init__(self, client, guild, moderator_id):
         self.state = State.REVIEW_START
         self.client = client  # the bot
+        self.guild = guild  # the GuildState whose reports are reviewed
+        self.moderator_id = moderator_id  # the moderator doing this review
         self.score = -1
         self.report = None
+        self.lease = None  # the lease on the report under review
         self.adversarial = False
 
     async def handle_message(self, message):
@@ -32,7 +35,7 @@ class Review:
             return ["Review cancelled."]
 
         if self.state == State.REVIEW_START:
-            if not self.client.unreviewed_reports:
+            if not self.guild.unreviewed_reports:
                 self.state = State.REVIEW_CANCELED
                 return ["There are no reviews to review."]
             reply = "Thank you for starting the review process. "
@@ -55,16 +58,43 @@ class Review:
         return self.state == State.REVIEW_COMPLETE
 
     def report_popped(self):
-        return self.report is not None
+        return self.lease is not None
+
+    def lease_expired(self) -> bool:
+        """Whether the report was taken away from the moderator for taking too long."""
+        return self.lease is not None and not self.guild.unreviewed_reports.holds(
+            self.lease
+        )
+
+    async def lease_report(self, oldest: bool) -> bool:
+        """Takes a report from the queue for review. Returns False if there are none left."""
+        lease = await self.client.lease_report(self.guild, self.moderator_id, oldest)
+        if lease is None:
+            return False
+        self.lease = lease
+        self.set_score(lease.score)
+        self.set_report(lease.report)
+        return True
+
+    async def cancel(self):
+        self.state = State.REVIEW_CANCELED
+        await self.client.clean_up_review(self.guild, self.moderator_id)
 
     async def finish_review(self, take_action: bool):
         """Finishes the report by setting the type to complete and calling the client's clean up funciton."""
         self.state = State.REVIEW_COMPLETE
+        if not self.guild.unreviewed_reports.complete(self.lease):
+            # The lease expired in the meantime. The report is reviewed again, so it isn't counted here.
+            await self.client.clean_up_review(self.guild, self.moderator_id)
+            return
         # Record statistics
-        self.client.statistics.add_report(self.report.score, take_action)
+        await self.report.load_statistics()
+        self.guild.statistics.add_report(self.report.score, take_action)
         if take_action:
-            self.client.statistics.increment_successful_reports(self.report.author.id)
-        await self.client.clean_up_review()
+            # Everyone who reported the message was right
+            for reporter in self.report.human_reporters():
+                self.guild.statistics.increment_successful_reports(reporter.id)
+        await self.client.clean_up_review(self.guild, self.moderator_id)
 
     # State setters and getters
     def set_report(self, report):
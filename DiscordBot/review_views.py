@@ -9,7 +9,11 @@ def create_embed(report):
         description=report.report_info(),
         color=discord.Color.yellow(),
     )
-    embed.set_author(name=f"Reported by {report.author.name}")
+    others = len(report.other_reporters)
+    if others:
+        embed.set_author(name=f"Reported by {report.author.name} and {others} more")
+    else:
+        embed.set_author(name=f"Reported by {report.author.name}")
     return embed
 
 
@@ -20,6 +24,18 @@ class ButtonView(ui.View):
         super().__init__()
         self.review = review
 
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        """Ignores buttons of a review whose report went back to the queue, so it isn't acted on twice."""
+        if not self.review.lease_expired():
+            return True
+        self.disable_buttons()
+        await interaction.response.edit_message(view=self)
+        await interaction.followup.send(
+            "You took too long to review this report, so it was put back into the queue. "
+            + "Please start a new review."
+        )
+        return False
+
     async def change_buttons(self, interaction: discord.Interaction, button):
         """Disable buttons and change `button` to green."""
         self.disable_buttons()
@@ -39,11 +55,14 @@ class MassReportingView(ButtonView):
     @discord.ui.button(label="No", style=discord.ButtonStyle.primary)
     async def risk_callback(self, interaction: discord.Interaction, button):
         await self.change_buttons(interaction, button)
-        # The author of the report should get punished
-        bully = self.review.report.author
-        await self.review.client.enforce_strike(
-            bully, self.review.report.message.content, self.review.adversarial
-        )
+        # The authors of the report should get punished
+        for bully in self.review.report.human_reporters():
+            await self.review.client.enforce_strike(
+                self.review.guild,
+                bully,
+                self.review.report.message.content,
+                self.review.adversarial,
+            )
         await self.review.finish_review(True)
 
     @discord.ui.button(label="Yes", style=discord.ButtonStyle.secondary)
@@ -52,11 +71,14 @@ class MassReportingView(ButtonView):
         await interaction.followup.send(
             "Please file separate reports for other involved users as well."
         )
-        # The author of the report should get punished
-        bully = self.review.report.author
-        await self.review.client.enforce_strike(
-            bully, self.review.report.message.content, self.review.adversarial
-        )
+        # The authors of the report should get punished
+        for bully in self.review.report.human_reporters():
+            await self.review.client.enforce_strike(
+                self.review.guild,
+                bully,
+                self.review.report.message.content,
+                self.review.adversarial,
+            )
         await self.review.finish_review(True)
 
 
@@ -103,7 +125,10 @@ class TypeOfViolationView(ButtonView):
         await self.change_buttons(interaction, button)
         bully = self.review.report.message.author
         await self.review.client.ban_user(
-            bully, self.review.report.message.content, self.review.adversarial
+            self.review.guild,
+            bully,
+            self.review.report.message.content,
+            self.review.adversarial,
         )
         await self.review.finish_review(True)
 
@@ -112,7 +137,10 @@ class TypeOfViolationView(ButtonView):
         await self.change_buttons(interaction, button)
         bully = self.review.report.message.author
         await self.review.client.enforce_strike(
-            bully, self.review.report.message.content, self.review.adversarial
+            self.review.guild,
+            bully,
+            self.review.report.message.content,
+            self.review.adversarial,
         )
         await self.review.finish_review(True)
 
@@ -129,7 +157,10 @@ class IsRiskView(ButtonView):
         )
         bully = self.review.report.message.author
         await self.review.client.ban_user(
-            bully, self.review.report.message.content, self.review.adversarial
+            self.review.guild,
+            bully,
+            self.review.report.message.content,
+            self.review.adversarial,
         )
         await self.review.finish_review(True)
 
@@ -152,8 +183,8 @@ class IsAccurateView(ButtonView):
             "Is the user(s) in immediate or actionable danger / risk of harm?",
             view=IsRiskView(self.review),
         )
-        reporter = self.review.report.author
-        await self.review.client.notify_reporter(reporter)
+        for reporter in self.review.report.human_reporters():
+            await self.review.client.notify_reporter(reporter)
 
     @discord.ui.button(label="No", style=discord.ButtonStyle.secondary)
     async def not_accurate_callback(self, interaction: discord.Interaction, button):
@@ -171,23 +202,22 @@ class ReviewStart(ButtonView):
     @discord.ui.button(label="Most Urgent", style=discord.ButtonStyle.primary)
     async def urgent_callback(self, interaction: discord.Interaction, button):
         await self.change_buttons(interaction, button)
-        (score, report) = self.review.client.pop_highest_priority_report()
-        self.review.set_score(score)
-        self.review.set_report(report)
-        await interaction.followup.send(
-            "Is the following report accurate for Bullying or Harassment?",
-            embed=create_embed(report),
-            view=IsAccurateView(self.review),
-        )
+        await self.show_report(interaction, oldest=False)
 
     @discord.ui.button(label="Oldest", style=discord.ButtonStyle.secondary)
     async def oldest_callback(self, interaction: discord.Interaction, button):
         await self.change_buttons(interaction, button)
-        (score, report) = self.review.client.pop_oldest_report()
-        self.review.set_score(score)
-        self.review.set_report(report)
+        await self.show_report(interaction, oldest=True)
+
+    async def show_report(self, interaction: discord.Interaction, oldest: bool):
+        # Another moderator might have taken the last report in the meantime.
+        if not await self.review.lease_report(oldest):
+            await interaction.followup.send("There are no reviews to review.")
+            await self.review.cancel()
+            return
+        await self.review.report.load_statistics()
         await interaction.followup.send(
             "Is the following report accurate for Bullying or Harassment?",
-            embed=create_embed(report),
+            embed=create_embed(self.review.report),
             view=IsAccurateView(self.review),
         )
@@ -0,0 +1,110 @@
+from cachetools import Cache, TTLCache
+from unidecode import unidecode
+from typing import Optional
+import hashlib
+import json
+import os
+import time
+
+
+class CountingTTLCache(TTLCache):
+    """TTLCache that counts how many entries were evicted and expired."""
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic, getsizeof=None):
+        super().__init__(maxsize, ttl, timer, getsizeof)
+        self.evictions = 0  # Entries removed because the cache was full
+        self.expirations = 0  # Entries removed because they were too old
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        # Count through the base class, TTLCache.__len__ would expire items itself.
+        size = Cache.__len__(self)
+        expired = super().expire(time)
+        self.expirations += size - Cache.__len__(self)
+        return expired
+
+
+class ScoreCache:
+    """Bounded LRU + TTL cache of concern scores, keyed on a hash of the unidecoded text."""
+
+    def __init__(self, maxsize: int, ttl: float, path: Optional[str] = None):
+        self.ttl = ttl
+        self.path = path  # Where the cache is persisted. None disables persistence.
+        self.loading_time = None  # Overrides the clock while loading from disk
+        # Uses the wall clock, so that entries can outlive a restart.
+        self.cache = CountingTTLCache(maxsize, ttl, timer=self.clock)
+        self.hits = 0
+        self.misses = 0
+
+    def clock(self) -> float:
+        if self.loading_time is not None:
+            return self.loading_time
+        return time.time()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(unidecode(text).encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[float]:
+        """Returns the cached score of `text` or None."""
+        entry = self.cache.get(self.key(text))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, text: str, score: float):
+        self.cache[self.key(text)] = (score, time.time())
+
+    def hit_rate(self) -> float:
+        if self.hits + self.misses == 0:
+            return 0
+        return round(self.hits / (self.hits + self.misses) * 100, 2)
+
+    def save(self):
+        """Writes all live entries to disk."""
+        if self.path is None:
+            return
+        self.cache.expire()
+        entries = [(key, score, stored) for key, (score, stored) in self.cache.items()]
+        # Every process of a sharded deployment saves its own cache
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Loads the entries written by `save`, skipping the ones that expired in the meantime."""
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        with open(self.path) as f:
+            entries = json.load(f)
+        now = time.time()
+        # Insert oldest first, so that the LRU order is preserved.
+        entries.sort(key=lambda entry: entry[2])
+        try:
+            for key, score, stored in entries:
+                if stored + self.ttl <= now:
+                    continue
+                # Pretend the entry is inserted at the time it was stored,
+                # so that it keeps its original expiry time.
+                self.loading_time = stored
+                self.cache[key] = (score, stored)
+        finally:
+            self.loading_time = None
+
+    def overview(self) -> str:
+        return (
+            "Score cache:\n```"
+            + f"\nEntries:     {self.cache.currsize}/{self.cache.maxsize}"
+            + f"\nHits:        {self.hits} ({self.hit_rate()}%)"
+            + f"\nMisses:      {self.misses}"
+            + f"\nEvictions:   {self.cache.evictions}"
+            + f"\nExpirations: {self.cache.expirations}"
+            + "\n```"
+        )
@@ -0,0 +1,26 @@
+# Runs the local model in worker processes, so that inference neither blocks the
+# event loop nor competes with the bot for the GIL.
+# Imported by the workers, so it must not import `perspective` (which reads tokens.json).
+import os
+from typing import List
+
+_scorer = None  # The model of this worker process
+
+
+def load_scorer(variant: str, path: str):
+    """Loads the model once when a worker starts. `variant` is "fp32", "int8" or "onnx"."""
+    global _scorer
+    # Each worker gets one core. Otherwise every worker spreads its forward pass
+    # over all cores and the workers slow each other down.
+    os.environ["OMP_NUM_THREADS"] = "1"
+    from local_model import BertScorer, OnnxScorer
+
+    if variant == "onnx":
+        _scorer = OnnxScorer(path)
+    else:
+        _scorer = BertScorer(path, quantize=variant == "int8")
+
+
+def predict(texts: List[str]) -> List[float]:
+    """Scores `texts` with the model of the current worker."""
+    return _scorer.predict(texts)
@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import threading
+
+
+class ShardStore:
+    """SQLite database shared by all processes of a sharded deployment.
+
+    A guild belongs to exactly one shard, so the state of a guild stays in the process
+    running its shard. Only what crosses shards is kept here: bans, so that every process
+    can refuse reports against banned users, and reports filed over DMs, which Discord
+    only delivers to shard 0, against messages in guilds of other processes.
+    """
+
+    BUSY_TIMEOUT = 5000  # Milliseconds to wait for another process's write
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()  # Forwarded reports are taken in a worker thread
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(f"PRAGMA busy_timeout={self.BUSY_TIMEOUT}")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS bans (guild_id INTEGER NOT NULL, "
+            + "user_id INTEGER NOT NULL, PRIMARY KEY (guild_id, user_id))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS forwarded_reports (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            + "shard_id INTEGER NOT NULL, guild_id INTEGER NOT NULL, report TEXT NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS forwarded_reports_shard ON forwarded_reports (shard_id)"
+        )
+        self.db.commit()
+
+    # -------- Bans --------
+    def add_ban(self, guild_id: int, user_id: int):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO bans VALUES (?, ?)", (guild_id, user_id)
+            )
+
+    def is_banned(self, guild_id: int, user_id: int) -> bool:
+        with self.lock:
+            return (
+                self.db.execute(
+                    "SELECT 1 FROM bans WHERE guild_id = ? AND user_id = ?",
+                    (guild_id, user_id),
+                ).fetchone()
+                is not None
+            )
+
+    def banned_users(self, guild_id: int) -> set:
+        """Returns the ids of all users banned from guild `guild_id`."""
+        with self.lock:
+            return {
+                user_id
+                for (user_id,) in self.db.execute(
+                    "SELECT user_id FROM bans WHERE guild_id = ?", (guild_id,)
+                )
+            }
+
+    # -------- Forwarded reports --------
+    def forward_report(self, shard_id: int, guild_id: int, report: dict):
+        """Hands a report over to the process running shard `shard_id`."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO forwarded_reports (shard_id, guild_id, report) VALUES (?, ?, ?)",
+                (shard_id, guild_id, json.dumps(report)),
+            )
+
+    def take_reports(self, shard_ids) -> list:
+        """Removes and returns all reports forwarded to the shards `shard_ids` as (guild id, report)."""
+        shard_ids = list(shard_ids)
+        placeholders = ", ".join("?" * len(shard_ids))
+        with self.lock, self.db:
+            rows = self.db.execute(
+                f"SELECT id, guild_id, report FROM forwarded_reports WHERE shard_id IN ({placeholders}) ORDER BY id",
+                shard_ids,
+            ).fetchall()
+            self.db.executemany(
+                "DELETE FROM forwarded_reports WHERE id = ?",
+                [(row[0],) for row in rows],
+            )
+        return [(guild_id, json.loads(report)) for _, guild_id, report in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
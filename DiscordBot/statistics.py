@@ -1,20 +1,40 @@
-from collections import defaultdict
+from array import array
+from calibration import Calibration
+from thresholds import ThresholdController
+from typing import Optional
+import asyncio
+import logging
 import random
+import sqlite3
+import threading
+import time
 
+logger = logging.getLogger("discord.statistics")
 
-class APIStatistics:
-    def __init__(self) -> None:
-        self.total_reports = 0
-        self.successful_reports = 0
 
-    def average_success_rate(self) -> float:
-        if self.total_reports == 0:
-            return 0
-        return round(self.successful_reports / self.total_reports * 100, 2)
+class UserStatistics:
+    """Keeps track of the statistics for one user.
 
+    Besides lifetime totals, keeps an exponentially decayed average and a ring buffer of
+    the last SENTIMENT_WINDOW scores, so that sudden escalation stands out.
+    """
 
-class UserStatistics:
-    """Keeps track of the statistics for one user."""
+    SENTIMENT_WINDOW = 20  # Number of recent scores kept
+    SENTIMENT_DECAY = 0.8  # Weight of the previous decayed average for each new message
+
+    # There is one of these per active member, so keep them small.
+    __slots__ = (
+        "strikes",
+        "reports_against",
+        "reports_authored",
+        "successful_reports",
+        "sentiment_total",
+        "num_messages_sent",
+        "last_active",
+        "decayed_sentiment",
+        "recent_scores",
+        "recent_index",
+    )
 
     def __init__(self) -> None:
         self.strikes = 0  # Number of strikes against the user
@@ -23,6 +43,45 @@ class UserStatistics:
         self.successful_reports = 0  # How many reports by user are successful
         self.sentiment_total = 0  # Sum of all sentiment scores of the user
         self.num_messages_sent = 0  # Total number of messages sent by the user
+        self.last_active = 0  # Unix time the statistics of the user last changed
+        self.decayed_sentiment = 0  # Exponentially decayed average sentiment score
+        self.recent_scores = (
+            None  # Ring buffer of recent sentiment scores, allocated on first use
+        )
+        self.recent_index = 0  # Number of scores ever written to the ring buffer
+
+    def add_sentiment(self, score: float):
+        self.sentiment_total += score
+        self.num_messages_sent += 1
+        if self.recent_scores is None:
+            self.recent_scores = array("f", [0.0]) * self.SENTIMENT_WINDOW
+        # Starts from 0, so that a single message can't make a new user look like they're escalating
+        self.decayed_sentiment = (
+            self.SENTIMENT_DECAY * self.decayed_sentiment
+            + (1 - self.SENTIMENT_DECAY) * score
+        )
+        self.recent_scores[self.recent_index % self.SENTIMENT_WINDOW] = score
+        self.recent_index += 1
+
+    def recent_scores_list(self):
+        if self.recent_scores is None:
+            return []
+        return self.recent_scores[: min(self.recent_index, self.SENTIMENT_WINDOW)]
+
+    def decayed_sentiment_score(self) -> float:
+        """Returns the exponentially decayed average sentiment score of the user."""
+        return round(self.decayed_sentiment * 100, 2)
+
+    def recent_sentiment_score(self) -> float:
+        """Returns the average sentiment score of the user's last SENTIMENT_WINDOW messages."""
+        recent = self.recent_scores_list()
+        if not recent:
+            return 0
+        return round(sum(recent) / len(recent) * 100, 2)
+
+    def peak_sentiment_score(self) -> float:
+        """Returns the highest sentiment score of the user's last SENTIMENT_WINDOW messages."""
+        return round(max(self.recent_scores_list(), default=0) * 100, 2)
 
     def average_sentiment_score(self) -> float:
         """Returns the average sentiment score of all the messages the user has sent."""
@@ -37,74 +96,360 @@ class UserStatistics:
         return round(self.successful_reports / self.reports_authored * 100, 2)
 
 
+# Returned for users without statistics, so that lookups don't allocate. Never modify!
+NO_STATISTICS = UserStatistics()
+
+
 class Statistics:
-    """Keeps track of all statistics needed for the bot."""
+    """Keeps track of all statistics needed for the bot.
 
-    PERCENTAGE_RANGE = 5  # how fine grained the api statistics are
+    All reads are served from memory. If a database path is given, the statistics are
+    loaded from SQLite on startup and changed rows are written back in batches.
+    Users idle for longer than IDLE_HORIZON are dropped from memory, but kept in the database.
+    Only their IDs are remembered, so that unknown users never cost a database read.
+    `load_user_async` reads an evicted user back without blocking the event loop.
+    """
 
-    def __init__(self):
-        # TODO: load dict from SQLite
-        self.user_statistics = defaultdict(UserStatistics)  # per user statistics
-        self.api_statistics = defaultdict(
-            APIStatistics
+    PERCENTAGE_RANGE = 5  # how fine grained the default api statistics overview is
+    FLUSH_INTERVAL = 5  # seconds between writes to the database
+    IDLE_HORIZON = 30 * 24 * 60 * 60  # seconds of inactivity before a user is evicted
+    EVICT_INTERVAL = 60 * 60  # seconds between scans for idle users
+
+    # Column name -> SQL type
+    USER_COLUMNS = {
+        "strikes": "INTEGER",
+        "reports_against": "INTEGER",
+        "reports_authored": "INTEGER",
+        "successful_reports": "INTEGER",
+        "sentiment_total": "REAL",
+        "num_messages_sent": "INTEGER",
+        "last_active": "REAL",
+        "decayed_sentiment": "REAL",
+        "recent_scores": "BLOB",
+        "recent_index": "INTEGER",
+    }
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        thresholds: Optional[ThresholdController] = None,
+    ):
+        self.user_statistics = {}  # per user statistics of recently active users
+        self.evicted_users = set()  # IDs of users in the database but not in memory
+        self.calibration = (
+            Calibration()
         )  # how effective the API is in predicting reports
+        self.thresholds = thresholds  # adjusted whenever a report was reviewed
+        # Rows changed since the last flush
+        self.dirty_users = set()
+        self.dirty_bins = set()
+        self.flush_task: asyncio.Task = None
+        self.last_eviction = time.monotonic()
+        self.db_lock = threading.Lock()  # Flushes run in a worker thread
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS user_statistics (user_id INTEGER PRIMARY KEY, "
+                + ", ".join(self.column_definition(c) for c in self.USER_COLUMNS)
+                + ")"
+            )
+            # Databases created by older versions lack some columns
+            columns = [
+                row[1] for row in self.db.execute("PRAGMA table_info(user_statistics)")
+            ]
+            for column in self.USER_COLUMNS:
+                if column not in columns:
+                    self.db.execute(
+                        f"ALTER TABLE user_statistics ADD COLUMN {self.column_definition(column)}"
+                    )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS calibration (bin INTEGER PRIMARY KEY, "
+                + "successful INTEGER NOT NULL, unsuccessful INTEGER NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS thresholds (name TEXT PRIMARY KEY, value REAL NOT NULL)"
+            )
+            self.migrate_api_statistics()
+            self.db.commit()
+            self.load()
+
+    # -------- Persistence --------
+    def column_definition(self, column: str) -> str:
+        sql_type = self.USER_COLUMNS[column]
+        if sql_type == "BLOB":
+            return f"{column} BLOB"
+        return f"{column} {sql_type} NOT NULL DEFAULT 0"
+
+    def migrate_api_statistics(self):
+        """Moves the 5% buckets of older versions into the calibration histogram."""
+        if not self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'api_statistics'"
+        ).fetchone():
+            return
+        for bucket, total, successful in self.db.execute(
+            "SELECT bucket, total_reports, successful_reports FROM api_statistics"
+        ):
+            # A bucket held the scores below its upper bound `bucket`%
+            b = self.calibration.bin((bucket - self.PERCENTAGE_RANGE) / 100)
+            self.db.execute(
+                "INSERT INTO calibration VALUES (?, ?, ?) ON CONFLICT(bin) DO UPDATE SET "
+                + "successful = successful + excluded.successful, "
+                + "unsuccessful = unsuccessful + excluded.unsuccessful",
+                (b, successful, total - successful),
+            )
+        self.db.execute("DROP TABLE api_statistics")
+
+    def load(self):
+        """Reads the statistics of recently active users and of the API into memory."""
+        for user_id, *values in self.db.execute(
+            f"SELECT user_id, {', '.join(self.USER_COLUMNS)} FROM user_statistics WHERE last_active >= ?",
+            (time.time() - self.IDLE_HORIZON,),
+        ):
+            self.user_statistics[user_id] = self.user_from_row(values)
+        for (user_id,) in self.db.execute(
+            "SELECT user_id FROM user_statistics WHERE last_active < ?",
+            (time.time() - self.IDLE_HORIZON,),
+        ):
+            self.evicted_users.add(user_id)
+        for b, successful, unsuccessful in self.db.execute(
+            "SELECT bin, successful, unsuccessful FROM calibration"
+        ):
+            self.calibration.successful[b] = successful
+            self.calibration.unsuccessful[b] = unsuccessful
+        if self.thresholds is not None:
+            for name, value in self.db.execute("SELECT name, value FROM thresholds"):
+                if name in self.thresholds.thresholds:
+                    self.thresholds.thresholds[name] = value
+
+    def user_from_row(self, values) -> UserStatistics:
+        user = UserStatistics()
+        for column, value in zip(self.USER_COLUMNS, values):
+            setattr(user, column, value)
+        if user.recent_scores is not None:
+            user.recent_scores = array("f", user.recent_scores)
+        return user
+
+    def user_to_row(self, user_id: int):
+        user = self.user_statistics[user_id]
+        values = [getattr(user, c) for c in self.USER_COLUMNS]
+        # The ring buffer is stored as raw bytes
+        return (user_id, *(v.tobytes() if isinstance(v, array) else v for v in values))
+
+    def read_user_row(self, user_id: int):
+        with self.db_lock:
+            return self.db.execute(
+                f"SELECT {', '.join(self.USER_COLUMNS)} FROM user_statistics WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+
+    def restore_user(self, user_id: int, row) -> Optional[UserStatistics]:
+        """Puts the row of an evicted user back into memory."""
+        self.evicted_users.discard(user_id)
+        if row is None:
+            return None
+        user = self.user_from_row(row)
+        self.user_statistics[user_id] = user
+        return user
+
+    def load_user(self, user_id: int) -> Optional[UserStatistics]:
+        """Reads the statistics of an evicted user from the database. This call blocks,
+        so it's only a fallback for callers outside the event loop.
+        """
+        if self.db is None or user_id not in self.evicted_users:
+            return None
+        return self.restore_user(user_id, self.read_user_row(user_id))
+
+    async def load_user_async(self, user_id: int):
+        """Reads the statistics of an evicted user back into memory without blocking the event loop."""
+        if self.db is None or user_id not in self.evicted_users:
+            return
+        row = await asyncio.to_thread(self.read_user_row, user_id)
+        # The user might have been loaded in the meantime
+        if user_id in self.evicted_users:
+            self.restore_user(user_id, row)
+
+    async def load_users_async(self, user_ids):
+        """Reads the statistics of all evicted users among `user_ids` back into memory
+        without blocking the event loop. Async callers do this before reading or changing them.
+        """
+        await asyncio.gather(*(self.load_user_async(i) for i in set(user_ids)))
+
+    def lookup_user(self, user_id: int) -> UserStatistics:
+        """Returns the statistics of a user for reading. Doesn't allocate anything for unknown users."""
+        user = self.user_statistics.get(user_id)
+        if user is None:
+            user = self.load_user(user_id)
+        return NO_STATISTICS if user is None else user
+
+    def user(self, user_id: int) -> UserStatistics:
+        """Returns the statistics of a user for modification and marks them as changed."""
+        user = self.user_statistics.get(user_id)
+        if user is None:
+            user = self.load_user(user_id) or UserStatistics()
+            self.user_statistics[user_id] = user
+        user.last_active = time.time()
+        self.dirty_users.add(user_id)
+        return user
+
+    def evict_idle_users(self):
+        """Drops users idle for longer than IDLE_HORIZON from memory. They stay in the database."""
+        if self.db is None:
+            return
+        horizon = time.time() - self.IDLE_HORIZON
+        idle = [
+            user_id
+            for user_id, user in self.user_statistics.items()
+            if user.last_active < horizon and user_id not in self.dirty_users
+        ]
+        for user_id in idle:
+            del self.user_statistics[user_id]
+            self.evicted_users.add(user_id)
+
+    def collect_dirty_rows(self):
+        """Copies all changed rows, so that they can be written without touching the live objects."""
+        user_rows = [self.user_to_row(user_id) for user_id in self.dirty_users]
+        bin_rows = [
+            (b, self.calibration.successful[b], self.calibration.unsuccessful[b])
+            for b in self.dirty_bins
+        ]
+        threshold_rows = []
+        if self.thresholds is not None and self.thresholds.changed:
+            threshold_rows = list(self.thresholds.thresholds.items())
+            self.thresholds.changed = False
+        self.dirty_users = set()
+        self.dirty_bins = set()
+        return user_rows, bin_rows, threshold_rows
+
+    def mark_dirty(self, user_rows, bin_rows, threshold_rows):
+        """Marks collected rows as changed again, so that the next flush retries them."""
+        self.dirty_users.update(row[0] for row in user_rows)
+        self.dirty_bins.update(row[0] for row in bin_rows)
+        if threshold_rows:
+            self.thresholds.changed = True
+
+    def write_rows(self, user_rows, bin_rows, threshold_rows):
+        """Writes the rows in a single transaction."""
+        with self.db_lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO user_statistics (user_id, {', '.join(self.USER_COLUMNS)}) "
+                + f"VALUES ({', '.join('?' * (len(self.USER_COLUMNS) + 1))})",
+                user_rows,
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO calibration VALUES (?, ?, ?)", bin_rows
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO thresholds VALUES (?, ?)", threshold_rows
+            )
+
+    def flush(self):
+        """Writes all changes to the database. This call blocks."""
+        if self.db is None:
+            return
+        rows = self.collect_dirty_rows()
+        try:
+            self.write_rows(*rows)
+        except Exception:
+            self.mark_dirty(*rows)
+            raise
+
+    async def flush_async(self):
+        """Writes all changes to the database without blocking the event loop."""
+        if self.db is None:
+            return
+        rows = self.collect_dirty_rows()
+        if not any(rows):
+            return
+        try:
+            await asyncio.to_thread(self.write_rows, *rows)
+        except Exception:
+            self.mark_dirty(*rows)
+            raise
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            try:
+                await self.flush_async()
+            except Exception:
+                # The rows stay dirty and are written by the next flush
+                logger.exception("Couldn't write the statistics to the database")
+            if time.monotonic() - self.last_eviction > self.EVICT_INTERVAL:
+                self.last_eviction = time.monotonic()
+                self.evict_idle_users()
+
+    def start_flushing(self):
+        """Starts writing changes to the database every FLUSH_INTERVAL seconds."""
+        if self.db is not None and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
 
     # -------- User Statistics --------
     def add_and_check_strike(self, user_id: int, limit: int) -> bool:
         """Adds a strike to the user and returns whether the user has more strikes than the limit."""
-        self.user_statistics[user_id].strikes += 1
-        return self.user_statistics[user_id].strikes >= limit
+        user = self.user(user_id)
+        user.strikes += 1
+        return user.strikes >= limit
 
     def get_strikes(self, user_id) -> int:
-        return self.user_statistics[user_id].strikes
+        return self.lookup_user(user_id).strikes
 
     def get_reports_against(self, user_id: int) -> int:
-        return self.user_statistics[user_id].reports_against
+        return self.lookup_user(user_id).reports_against
 
     def get_average_sentiment_score(self, user_id: int) -> float:
-        return self.user_statistics[user_id].average_sentiment_score()
+        return self.lookup_user(user_id).average_sentiment_score()
 
     def get_average_report_accuracy(self, user_id: int) -> float:
-        return self.user_statistics[user_id].average_report_accuracy()
+        return self.lookup_user(user_id).average_report_accuracy()
 
     def increment_reports_against(self, user_id: int):
-        self.user_statistics[user_id].reports_against += 1
+        self.user(user_id).reports_against += 1
 
     def increment_reports_sent(self, user_id: int):
-        self.user_statistics[user_id].reports_authored += 1
+        self.user(user_id).reports_authored += 1
 
     def increment_successful_reports(self, user_id: int):
-        self.user_statistics[user_id].successful_reports += 1
+        self.user(user_id).successful_reports += 1
+
+    def get_decayed_sentiment_score(self, user_id: int) -> float:
+        return self.lookup_user(user_id).decayed_sentiment_score()
+
+    def get_recent_sentiment_score(self, user_id: int) -> float:
+        return self.lookup_user(user_id).recent_sentiment_score()
+
+    def get_peak_sentiment_score(self, user_id: int) -> float:
+        return self.lookup_user(user_id).peak_sentiment_score()
 
     def add_sentiment(self, user_id: int, score: float):
-        self.user_statistics[user_id].sentiment_total += score
-        self.user_statistics[user_id].num_messages_sent += 1
+        self.user(user_id).add_sentiment(score)
 
     # -------- API Statistics --------
     def add_report(self, score: float, successful: bool):
         """Adds a (successful) report to the statistics of the API."""
-        # Convert score into next multiple of PERCENT_RANGE
-        rounded_score = (
-            (round(score * 100) // self.PERCENTAGE_RANGE) + 1
-        ) * self.PERCENTAGE_RANGE
-        self.api_statistics[rounded_score].total_reports += 1
-        if successful:
-            self.api_statistics[rounded_score].successful_reports += 1
-
-    def api_statistics_overview(self) -> str:
-        overview = "How often do concern scores in the following ranges lead to successful reports?\n```"
-        for i in range(100 // self.PERCENTAGE_RANGE):
-            upper_bound = (i + 1) * self.PERCENTAGE_RANGE
-            success_rate = self.api_statistics[upper_bound].average_success_rate()
-            overview += "\n{:>2d}-{:>3d}%:".format(
-                i * self.PERCENTAGE_RANGE, upper_bound
-            )
-            overview += "{:>6s}".format(
-                f"{self.api_statistics[upper_bound].successful_reports}/{self.api_statistics[upper_bound].total_reports}"
-            )
-            overview += "   " + "∎" * (int(success_rate) // 10)
-        overview += "\n```"
-        return overview
+        self.calibration.add(score, successful)
+        self.dirty_bins.add(self.calibration.bin(score))
+        if self.thresholds is not None:
+            self.thresholds.observe_review(self.calibration)
+
+    def api_statistics_overview(
+        self, low: float = 0, high: float = 1, step: float = None
+    ) -> str:
+        """Chart of how often scores between `low` and `high` led to successful reports."""
+        if step is None:
+            step = self.PERCENTAGE_RANGE / 100
+        return self.calibration.overview(low, high, step)
 
 
 if __name__ == "__main__":
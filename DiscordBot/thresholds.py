@@ -0,0 +1,91 @@
+from calibration import Calibration
+import logging
+import math
+import time
+
+logger = logging.getLogger("discord.thresholds")
+
+
+class ThresholdController:
+    """Adjusts the auto-moderation thresholds online from review outcomes.
+
+    The autoreport threshold steers the number of auto-reports towards `target_inflow`
+    per hour, so moderators are neither flooded during raids nor starved. It is adjusted
+    after every review and, since starved moderators finish no reviews, on every `tick`.
+    The autosuspend and autoban thresholds move towards the lowest threshold
+    that reaches their target precision according to the calibration histogram.
+    Every adjustment is at most STEP and stays within the configured bounds.
+    """
+
+    STEP = 0.01  # Largest change per review outcome
+    INFLOW_WINDOW = 60 * 60  # Seconds the inflow rate is averaged over
+    TOLERANCE = 0.2  # Relative deviation from the target inflow that is accepted
+    MIN_REVIEWS = 50  # Reviews above a threshold needed before trusting its precision
+    INFLOW_INTERVAL = (
+        5 * 60
+    )  # Seconds between inflow adjustments while no reviews finish
+
+    def __init__(
+        self,
+        thresholds: dict,
+        bounds: dict,
+        target_precisions: dict,
+        target_inflow: float,
+    ):
+        self.thresholds = dict(thresholds)  # Name -> current threshold
+        self.bounds = bounds  # Name -> (lowest, highest) allowed threshold
+        self.target_precisions = target_precisions  # Name -> precision to reach
+        self.target_inflow = target_inflow  # Auto-reports per hour
+        self.inflow_rate = target_inflow  # Exponentially decayed auto-reports per hour
+        self.last_inflow = time.monotonic()
+        self.last_inflow_adjustment = time.monotonic()
+        self.changed = (
+            False  # Whether the thresholds changed since they were last saved
+        )
+
+    def __getitem__(self, name: str) -> float:
+        return self.thresholds[name]
+
+    def current_inflow(self) -> float:
+        """Returns the decayed number of auto-reports per hour."""
+        elapsed = time.monotonic() - self.last_inflow
+        return self.inflow_rate * math.exp(-elapsed / self.INFLOW_WINDOW)
+
+    def record_autoreport(self):
+        self.inflow_rate = self.current_inflow() + 60 * 60 / self.INFLOW_WINDOW
+        self.last_inflow = time.monotonic()
+
+    def tick(self):
+        """Called periodically, so that the autoreport threshold follows the inflow without reviews."""
+        if time.monotonic() - self.last_inflow_adjustment >= self.INFLOW_INTERVAL:
+            self.adjust_inflow()
+
+    def adjust_inflow(self):
+        self.last_inflow_adjustment = time.monotonic()
+        inflow = self.current_inflow()
+        if inflow > self.target_inflow * (1 + self.TOLERANCE):
+            self.adjust("AUTOREPORT_THRESHOLD", self.STEP, f"inflow {inflow:.1f}/h")
+        elif inflow < self.target_inflow * (1 - self.TOLERANCE):
+            self.adjust("AUTOREPORT_THRESHOLD", -self.STEP, f"inflow {inflow:.1f}/h")
+
+    def observe_review(self, calibration: Calibration):
+        """Called whenever a review finished, after the outcome was added to `calibration`."""
+        self.adjust_inflow()
+        for name in ["AUTOSUSPEND_THRESHOLD", "AUTOBAN_THRESHOLD"]:
+            suggestion = calibration.suggest_threshold(
+                self.target_precisions[name], self.MIN_REVIEWS
+            )
+            if suggestion is None:
+                continue
+            delta = max(min(suggestion - self.thresholds[name], self.STEP), -self.STEP)
+            self.adjust(name, delta, f"suggested {suggestion}")
+
+    def adjust(self, name: str, delta: float, reason: str):
+        low, high = self.bounds[name]
+        old = self.thresholds[name]
+        new = round(min(max(old + delta, low), high), 4)
+        if new == old:
+            return
+        self.thresholds[name] = new
+        self.changed = True
+        logger.info(f"{name} changed from {old} to {new} ({reason})")
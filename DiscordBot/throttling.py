@@ -0,0 +1,113 @@
+import asyncio
+import random
+import time
+
+
+class ScoringUnavailable(Exception):
+    """The scoring backend can't take more requests right now. Try again later."""
+
+
+class TokenBucket:
+    """Rate limiter allowing `rate` calls per second on average and bursts of `capacity` calls.
+
+    Tokens are reserved in order of arrival, so callers are served first come, first served.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity  # Negative when tokens are reserved for waiting callers
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.capacity)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds the next caller would have to wait for a token."""
+        self.refill()
+        return max(1 - self.tokens, 0) / self.rate
+
+    async def acquire(self, max_delay: float) -> bool:
+        """Waits for a token. Returns whether the caller had to wait.
+        Raises ScoringUnavailable instead of waiting longer than `max_delay` seconds.
+        """
+        delay = self.delay()
+        if delay > max_delay:
+            raise ScoringUnavailable(f"rate limited for {delay:.1f}s")
+        self.tokens -= 1
+        if delay == 0:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+
+class CircuitBreaker:
+    """Stops calling a failing API.
+
+    Opens after `failure_threshold` failures in a row. While open, calls are refused.
+    After `reset_timeout` seconds a single call is let through to probe the API:
+    if it succeeds the breaker closes, otherwise it stays open for another `reset_timeout`.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0  # Failures in a row
+        self.opened_at = (
+            None  # Monotonic time the breaker opened or last let a probe through
+        )
+        self.trips = 0
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a call may be made now."""
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        # Let this call probe the API. Everyone else waits for its outcome.
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Seconds to wait before retry number `attempt` (from 0): full jitter exponential backoff."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class CallStatistics:
+    """Counts what happened to calls to a rate limited API."""
+
+    def __init__(self) -> None:
+        self.throttled = 0  # Calls that waited for the rate limiter
+        self.retried = 0  # Retries after a transient error
+        self.failed = 0  # Calls that failed after all retries
+        self.deferred = 0  # Messages put aside to be scored later
+        self.dropped = 0  # Deferred messages that were never scored
+
+    def overview(self, breaker: CircuitBreaker) -> str:
+        return (
+            "Scoring API calls:\n```"
+            + f"\nthrottled {self.throttled:>8d}"
+            + f"\nretried   {self.retried:>8d}"
+            + f"\nfailed    {self.failed:>8d}"
+            + f"\ndeferred  {self.deferred:>8d}"
+            + f"\ndropped   {self.dropped:>8d}"
+            + f"\ncircuit breaker {'open' if breaker.is_open() else 'closed'}, tripped {breaker.trips} times"
+            + "\n```"
+        )